@@ -0,0 +1,469 @@
+#!/bin/python3.10
+# Local stand-in for the jellyfin and musicbrainz servers used by jellyfin_meta_data_updater.py
+# Serves a synthetic library, jellyfin is served from / and musicbrainz from /ws/2
+# The library has single disc albums, multi disc albums, albums split into disc folders, vinyl and albums without MBIDs
+# Latency, a musicbrainz rate limit and errors can be added to see how the script copes with them
+
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+TRACKS_PER_DISC = 10
+
+
+def hexid(kind, number):
+    # Stable 32 character jellyfin style id
+    return uuid.uuid5(uuid.NAMESPACE_OID, f"{kind}-{number}").hex
+
+
+def mbid(kind, number):
+    # Stable musicbrainz style id
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{kind}-{number}"))
+
+
+class Library:
+    # Synthetic library, albums are generated from their index so nothing is stored up front
+    def __init__(self, albums, artists_per=4):
+        self.album_count = albums
+        self.artists_per = artists_per
+        self.albums_by_id = {}
+        self.items = {}
+        self.playlists = {}
+        for number in range(albums):
+            self.albums_by_id[hexid("album", number)] = number
+
+    def kind(self, number):
+        # Multi disc albums, albums split into disc folders, vinyl and albums without MBIDs
+        if number % 17 == 5:
+            return "nombid"
+        if number % 13 == 3:
+            return "vinyl"
+        if number % 11 == 2:
+            return "folders"
+        if number % 7 == 1:
+            return "multidisc"
+        return "single"
+
+    def discs(self, number):
+        return 2 if self.kind(number) in ("multidisc", "folders") else 1
+
+    def album(self, number):
+        album_id = hexid("album", number)
+        artist = number // self.artists_per
+        item = {
+            "Name": f"Album {number}",
+            "ServerId": "fake",
+            "Id": album_id,
+            "Type": "MusicAlbum",
+            "IsFolder": True,
+            "ProductionYear": 2000 + number % 20,
+            "AlbumArtist": f"Artist {artist}",
+            "AlbumArtists": [{"Name": f"Artist {artist}", "Id": hexid("artist", artist)}],
+            "ArtistItems": [{"Name": f"Artist {artist}", "Id": hexid("artist", artist)}],
+            "Artists": [f"Artist {artist}"],
+            "ImageTags": {"Primary": "x" * 32},
+            "ImageBlurHashes": {"Primary": {"x" * 32: "LKO2?U%2Tw=w]~RBVZRi};RPxuwH"}},
+            "UserData": {"PlaybackPositionTicks": 0, "PlayCount": 0, "IsFavorite": False, "Played": False, "Key": album_id},
+            "ProviderIds": {"MusicBrainzAlbumArtist": mbid("artist", artist)},
+            "Genres": [],
+            "Tags": [],
+            "Studios": [],
+            "ParentId": hexid("library", 0),
+            "DateLastSaved": "2024-01-01T00:00:00.0000000Z",
+        }
+        if self.kind(number) != "nombid":
+            item["ProviderIds"]["MusicBrainzAlbum"] = mbid("release", number)
+            item["ProviderIds"]["MusicBrainzReleaseGroup"] = mbid("release-group", number)
+        item.update(self.items.get(album_id, {}))
+        return item
+
+    def folders(self, number):
+        if self.kind(number) != "folders":
+            return []
+        return [{"Name": f"Disc {disc}", "Id": hexid(f"folder-{number}", disc), "Type": "Folder", "IsFolder": True,
+                 "ParentId": hexid("album", number)} for disc in range(1, 3)]
+
+    def tracks(self, number, disc_filter=None):
+        album_id = hexid("album", number)
+        artist = number // self.artists_per
+        kind = self.kind(number)
+        tracks = []
+        for disc in range(1, self.discs(number) + 1):
+            if disc_filter is not None and disc != disc_filter:
+                continue
+            for position in range(1, TRACKS_PER_DISC + 1):
+                track_id = hexid(f"track-{number}", disc * 100 + position)
+                parent_id = hexid(f"folder-{number}", disc) if kind == "folders" else album_id
+                path = f"/music/Artist {artist}/Album {number}/{'Disc %d/' % disc if kind == 'folders' else ''}{position:02d} Track {position}.flac"
+                track = {
+                    "Name": f"Track {disc}-{position}",
+                    "ServerId": "fake",
+                    "Id": track_id,
+                    "Type": "Audio",
+                    "MediaType": "Audio",
+                    "IndexNumber": position,
+                    "RunTimeTicks": (180 + position) * 10000000,
+                    "ProductionYear": 2000 + number % 20,
+                    "Album": f"Album {number}",
+                    "AlbumId": album_id,
+                    "AlbumArtist": f"Artist {artist}",
+                    "AlbumArtists": [{"Name": f"Artist {artist}", "Id": hexid("artist", artist)}],
+                    "ArtistItems": [{"Name": f"Artist {artist}", "Id": hexid("artist", artist)}],
+                    "Artists": [f"Artist {artist}"],
+                    "ParentId": parent_id,
+                    "Path": path,
+                    "ProviderIds": {},
+                    "Genres": [],
+                    "Tags": [],
+                    "Studios": [],
+                    "ImageBlurHashes": {"Primary": {"x" * 32: "LKO2?U%2Tw=w]~RBVZRi};RPxuwH"}},
+                    "UserData": {"PlaybackPositionTicks": 0, "PlayCount": 3, "IsFavorite": False, "Played": True, "Key": track_id},
+                    "MediaSources": [{
+                        "Protocol": "File", "Id": track_id, "Path": path, "Type": "Default", "Container": "flac",
+                        "Size": 30000000, "Name": f"Track {position}", "IsRemote": False, "RunTimeTicks": (180 + position) * 10000000,
+                        "SupportsTranscoding": True, "SupportsDirectStream": True, "SupportsDirectPlay": True,
+                        "MediaStreams": [{"Codec": "flac", "TimeBase": "1/44100", "Type": "Audio", "Channels": 2, "SampleRate": 44100,
+                                          "BitDepth": 16, "Index": 0, "IsDefault": False, "IsExternal": False, "Language": "eng",
+                                          "DisplayTitle": "FLAC - Stereo", "ChannelLayout": "stereo", "BitRate": 900000}],
+                        "Formats": [], "Bitrate": 900000, "RequiredHttpHeaders": {}}],
+                }
+                # Jellyfin reads the disc number from the file tags, single disc albums are usually disc 1
+                if kind != "folders":
+                    track["ParentIndexNumber"] = disc
+                track.update(self.items.get(track_id, {}))
+                tracks.append(track)
+        return tracks
+
+    def release(self, number):
+        artist = number // self.artists_per
+        media = []
+        for disc in range(1, self.discs(number) + 1):
+            media.append({
+                "position": disc,
+                "format": "12\" Vinyl" if self.kind(number) == "vinyl" else "CD",
+                "track-count": TRACKS_PER_DISC,
+                "tracks": [{
+                    "id": mbid(f"track-{number}", disc * 100 + position),
+                    "number": str(position),
+                    "position": position,
+                    "title": f"Track {disc}-{position}",
+                    "length": (180 + position) * 1000,
+                    "recording": {"id": mbid(f"recording-{number}", disc * 100 + position), "title": f"Track {disc}-{position}",
+                                  "length": (180 + position) * 1000, "video": False},
+                } for position in range(1, TRACKS_PER_DISC + 1)],
+            })
+        return {"id": mbid("release", number), "title": f"Album {number}", "media": media,
+                "artist-credit": [{"name": f"Artist {artist}", "artist": {"id": mbid("artist", artist), "name": f"Artist {artist}"}}]}
+
+    def release_group(self, number):
+        artist = number // self.artists_per
+        credit = [{"name": f"Artist {artist}", "artist": {"id": mbid("artist", artist), "name": f"Artist {artist}"}}]
+        if number % 19 == 4:
+            credit = [{"name": "Various Artists", "artist": {"id": mbid("artist", "various"), "name": "Various Artists"}}]
+        genres = [{"name": "rock", "count": 5}, {"name": f"genre {number % 5}", "count": 3}, {"name": "weak", "count": 1}]
+        return {"id": mbid("release-group", number), "title": f"Album {number}", "artist-credit": credit, "genres": genres,
+                "tags": genres + [{"name": "seen live", "count": 4}]}
+
+    def artist(self, artist):
+        genres = [{"name": "pop", "count": 4}, {"name": f"artist genre {artist % 3}", "count": 2}]
+        return {"id": mbid("artist", artist), "name": f"Artist {artist}", "genres": genres, "tags": genres}
+
+
+OPTIONAL_FIELDS = ("ProviderIds", "Genres", "Tags", "Studios", "ParentId", "Path", "MediaSources", "DateLastSaved")
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.writes = 0
+        self.bytes = 0
+
+    def add(self, key, size):
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytes += size
+
+
+def make_handler(library, stats, latency=0.0, mb_rate=0.0, error_rate=0.0, error_status=503, token_lifetime=0):
+    mb_lock = threading.Lock()
+    mb_last = [0.0]
+    mbids = {}
+    for number in range(library.album_count):
+        mbids[mbid("release", number)] = ("release", number)
+        mbids[mbid("release-group", number)] = ("release-group", number)
+    for artist in range(library.album_count // library.artists_per + 1):
+        mbids[mbid("artist", artist)] = ("artist", artist)
+
+    # Requests each login token has left before it expires, token_lifetime 0 never expires them
+    tokens = {}
+    tokens_lock = threading.Lock()
+
+    def token_valid(token):
+        with tokens_lock:
+            if token not in tokens:
+                return False
+            if token_lifetime:
+                tokens[token] -= 1
+                return tokens[token] >= 0
+            return True
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately, without this each response waits for a delayed ack
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body=None):
+            data = b"" if body is None else json.dumps(body).encode()
+            self.send_response(status)
+            if body is not None:
+                self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            stats.add(self.endpoint, len(data))
+
+        def params(self):
+            query = parse_qs(urlparse(self.path).query)
+            return {k.lower(): v[0] for k, v in query.items()}
+
+        def body(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"null")
+
+        def common(self):
+            path = urlparse(self.path).path
+            self.endpoint = self.command + " " + re.sub(r"[0-9a-f-]{32,36}", "{id}", path)
+            if latency:
+                time.sleep(latency)
+            if error_rate and random.random() < error_rate:
+                # Read the body so it is not taken as the next request on the connection
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(error_status)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                stats.add(self.endpoint, 0)
+                return None
+            token = self.headers.get("x-mediabrowser-token")
+            if (token is not None or path == "/Users/Me") and not token_valid(token):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_json(401)
+                return None
+            return path
+
+        def do_GET(self):
+            path = self.common()
+            if path is None:
+                return
+            if path.startswith("/ws/2/"):
+                return self.musicbrainz(path[6:])
+            p = self.params()
+            if path == "/Users/Me":
+                return self.send_json(200, {"Id": "user"})
+            m = re.match(r"/Playlists/([^/]+)/Items$", path)
+            if m:
+                items = library.playlists.get(m.group(1))
+                if items is None:
+                    # playlist-<number> is a playlist of that many tracks from the library
+                    size = re.match(r"playlist-(\d+)$", m.group(1))
+                    if size is None:
+                        return self.send_json(404, {})
+                    items = [hexid(f"track-{i // TRACKS_PER_DISC}", 100 + i % TRACKS_PER_DISC + 1) for i in range(int(size.group(1)))]
+                    library.playlists[m.group(1)] = items
+                start = int(p.get("startindex", 0))
+                limit = int(p.get("limit", len(items)))
+                page = items[start:start + limit]
+                return self.send_json(200, {"Items": [{"Id": i, "Name": "x", "Type": "Audio"} for i in page], "TotalRecordCount": len(items), "StartIndex": start})
+            if path == "/Items":
+                return self.send_json(200, self.project(self.items(p), p))
+            self.send_json(404, {})
+
+        def project(self, result, p):
+            # Drop optional fields that were not requested, like jellyfin does
+            fields = {f.lower() for f in p.get("fields", "").split(",") if f}
+            for item in result["Items"]:
+                for key in OPTIONAL_FIELDS:
+                    if key.lower() not in fields:
+                        item.pop(key, None)
+                if p.get("enableimages", "").lower() == "false":
+                    item.pop("ImageTags", None)
+                    item.pop("ImageBlurHashes", None)
+                if p.get("enableuserdata", "").lower() == "false":
+                    item.pop("UserData", None)
+            return result
+
+        def items(self, p):
+            start = int(p.get("startindex", 0))
+            if "ids" in p:
+                found = []
+                for item_id in p["ids"].split(","):
+                    if item_id in library.albums_by_id:
+                        found.append(library.album(library.albums_by_id[item_id]))
+                return {"Items": found, "TotalRecordCount": len(found)}
+            if "parentid" in p:
+                parent = p["parentid"]
+                if parent in library.albums_by_id:
+                    number = library.albums_by_id[parent]
+                    if library.kind(number) == "folders":
+                        found = library.folders(number) if p.get("includeitemtypes", "").lower() == "folder" else []
+                    else:
+                        found = library.tracks(number)
+                    return {"Items": found, "TotalRecordCount": len(found)}
+                for number in library.albums_by_id.values():
+                    for folder in library.folders(number):
+                        if folder["Id"] == parent:
+                            found = library.tracks(number, int(folder["Name"][-1]))
+                            return {"Items": found, "TotalRecordCount": len(found)}
+                return {"Items": [], "TotalRecordCount": 0}
+            types = p.get("includeitemtypes", "").lower()
+            if types == "musicalbum":
+                total = library.album_count
+                limit = int(p.get("limit", total))
+                if "mindatelastsaved" in p:
+                    # The dates are all written the same way so they compare as strings
+                    cutoff = p["mindatelastsaved"].rstrip("Z")
+                    numbers = [number for number in range(total) if library.album(number)["DateLastSaved"].rstrip("Z")[:len(cutoff)] >= cutoff]
+                    found = [library.album(number) for number in numbers[start:start + limit]]
+                    return {"Items": found, "TotalRecordCount": len(numbers), "StartIndex": start}
+                found = [library.album(number) for number in range(start, min(total, start + limit))]
+                return {"Items": found, "TotalRecordCount": total, "StartIndex": start}
+            if types == "audio" and "albumids" in p:
+                tracks = []
+                for album_id in p["albumids"].split(","):
+                    if album_id in library.albums_by_id:
+                        tracks += library.tracks(library.albums_by_id[album_id])
+                limit = int(p.get("limit", len(tracks)))
+                return {"Items": tracks[start:start + limit], "TotalRecordCount": len(tracks), "StartIndex": start}
+            if types == "audio":
+                found = []
+                limit = int(p.get("limit", 10 ** 9))
+                position = 0
+                total = sum(library.discs(n) * TRACKS_PER_DISC for n in range(library.album_count))
+                for number in range(library.album_count):
+                    size = library.discs(number) * TRACKS_PER_DISC
+                    if position + size <= start:
+                        position += size
+                        continue
+                    for track in library.tracks(number):
+                        if position >= start and len(found) < limit:
+                            found.append(track)
+                        position += 1
+                    if len(found) >= limit:
+                        break
+                return {"Items": found, "TotalRecordCount": total, "StartIndex": start}
+            return {"Items": [], "TotalRecordCount": 0}
+
+        def do_POST(self):
+            path = self.common()
+            if path is None:
+                return
+            p = self.params()
+            if path == "/Users/AuthenticateByName":
+                self.body()
+                with tokens_lock:
+                    token = f"token-{len(tokens) + 1}"
+                    tokens[token] = token_lifetime
+                return self.send_json(200, {"AccessToken": token, "User": {"Id": "user"}})
+            m = re.match(r"/Items/([^/]+)$", path)
+            if m:
+                body = self.body()
+                with stats.lock:
+                    stats.writes += 1
+                library.items[m.group(1)] = {k: v for k, v in body.items() if k in ("Genres", "ProviderIds", "IndexNumber", "ParentIndexNumber")}
+                saved = time.time()
+                library.items[m.group(1)]["DateLastSaved"] = f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(saved))}.{int(saved % 1 * 10000000):07d}Z"
+                return self.send_json(204)
+            if path == "/Playlists":
+                body = self.body()
+                playlist_id = uuid.uuid4().hex
+                library.playlists[playlist_id] = list(body.get("Ids", []))
+                return self.send_json(200, {"Id": playlist_id})
+            m = re.match(r"/Playlists/([^/]+)/Items$", path)
+            if m:
+                library.playlists.setdefault(m.group(1), []).extend(p.get("ids", "").split(","))
+                return self.send_json(204)
+            self.send_json(404, {})
+
+        def musicbrainz(self, path):
+            if mb_rate:
+                with mb_lock:
+                    now = time.monotonic()
+                    if now - mb_last[0] < 1.0 / mb_rate:
+                        self.send_response(503)
+                        self.send_header("Retry-After", "1")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        stats.add(self.endpoint, 0)
+                        return
+                    mb_last[0] = now
+            p = self.params()
+            if path == "genre/all":
+                names = ["rock", "pop", "weak"] + [f"genre {i}" for i in range(5)] + [f"artist genre {i}" for i in range(3)]
+                if p.get("fmt") == "txt":
+                    data = "\n".join(names).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    stats.add(self.endpoint, len(data))
+                    return
+                return self.send_json(200, {"genre-count": len(names), "genres": [{"name": n} for n in names]})
+            m = re.match(r"(release|release-group|artist)/([0-9a-f-]+)$", path)
+            if m:
+                entity = mbids.get(m.group(2))
+                if entity is None or entity[0] != m.group(1):
+                    return self.send_json(404, {"error": "Not Found"})
+                kind, number = entity
+                body = getattr(library, kind.replace("-", "_"))(number)
+                return self.send_json(200, body)
+            m = re.match(r"(release-group|artist)$", path)
+            if m and "query" in p:
+                ids = re.findall(r"[0-9a-f-]{36}", p["query"])
+                results = []
+                for entity_id in ids:
+                    entity = mbids.get(entity_id)
+                    if entity and entity[0] == m.group(1):
+                        body = dict(getattr(library, entity[0].replace("-", "_"))(entity[1]))
+                        body.pop("genres", None)
+                        results.append(body)
+                offset = int(p.get("offset", 0))
+                limit = int(p.get("limit", 25))
+                key = "release-groups" if m.group(1) == "release-group" else "artists"
+                return self.send_json(200, {"count": len(results), "offset": offset, key: results[offset:offset + limit]})
+            self.send_json(404, {"error": "Not Found"})
+
+    return Handler
+
+
+def serve(albums=100, port=0, latency=0.0, mb_rate=0.0, error_rate=0.0, error_status=503, token_lifetime=0):
+    # Start the servers in a background thread, port 0 picks a free port
+    library = Library(albums)
+    stats = Stats()
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(library, stats, latency, mb_rate, error_rate, error_status, token_lifetime))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, library, stats
+
+
+if __name__ == "__main__":
+    # eg: fake_servers.py 1000 8096, then run the script with JELLYFIN_SERVER=http://127.0.0.1:8096 MUSICBRAINZ_SERVER=http://127.0.0.1:8096/ws/2
+    server, library, stats = serve(int(sys.argv[1]) if len(sys.argv) > 1 else 100, int(sys.argv[2]) if len(sys.argv) > 2 else 8096)
+    print(f"Serving {library.album_count} albums on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(5)
+            print(json.dumps(stats.requests), stats.writes)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,173 @@
+#!/bin/python3.10
+# Benchmarks for jellyfin_meta_data_updater.py using the local stand-in servers in fake_servers.py
+# Each scenario runs the script against a fresh synthetic library and reports how long it took and the requests it sent
+#
+# eg: run_benchmarks.py --albums=1000,10000 --scenarios=all,genre,shuffle --save=baseline.json
+#     run_benchmarks.py --albums=1000,10000 --compare=baseline.json
+
+import getopt
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_servers
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "jellyfin_meta_data_updater.py")
+
+# Script arguments for each scenario, shuffle uses a playlist with 10 tracks for every album
+scenarios = {
+    "all": lambda albums: ["all", "--verify-off"],
+    "genre": lambda albums: ["all", "--genre"],
+    "shuffle": lambda albums: [f"playlist-{albums * fake_servers.TRACKS_PER_DISC}", "--shuffle=benchmark"]
+}
+
+album_counts = [1000]
+scenario_names = ["all", "genre", "shuffle"]
+# Server behaviour
+latency = 0.0
+mb_rate = 0.0
+error_rate = 0.0
+# Extra arguments for the script, musicbrainz is not rate limited by default so the benchmark measures the script
+script_args = ["--mb-rate=0"]
+save_file = None
+compare_file = None
+# A scenario is a regression if it is this much slower than the compared results
+tolerance = 0.2
+output_file = None
+
+def help_doc():
+    print("Usage: run_benchmarks.py [--albums=1000,10000,100000] [--scenarios=all,genre,shuffle] [--latency=<seconds>] [--mb-rate=<requests per second>] [--error-rate=<0-1>] [--args=<script arguments>] [--save=<file>] [--compare=<file> [--tolerance=0.2]] [--output=<file>]")
+    print("--albums: Sizes of the synthetic libraries (Default: 1000)")
+    print("--scenarios: all updates track ids with --verify-off, genre runs all --genre and shuffle shuffles a playlist with 10 tracks per album (Default: all,genre,shuffle)")
+    print("--latency: Seconds the servers wait before answering each request (Default: 0)")
+    print("--mb-rate: Requests per second the musicbrainz server allows before answering 503 (Default: no limit)")
+    print("--error-rate: Fraction of requests answered with 503 (Default: 0)")
+    print("--args: Extra arguments for the script, eg: --args=\"--workers=4\" (Default: --mb-rate=0)")
+    print("--save: Write the results to a file")
+    print("--compare: Compare with results saved with --save and exit with an error if a scenario is more than --tolerance slower")
+    print("--output: File the output of the script is appended to, it is not kept by default")
+    sys.exit(1)
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "", ["albums=", "scenarios=", "latency=", "mb-rate=", "error-rate=", "args=", "save=", "compare=", "tolerance=", "output=", "help"])
+except getopt.GetoptError as err:
+    print(err)
+    sys.exit(1)
+
+for opt, arg in opts:
+    if opt == "--albums":
+        album_counts = [int(count) for count in arg.split(",")]
+    elif opt == "--scenarios":
+        scenario_names = arg.split(",")
+        for name in scenario_names:
+            if name not in scenarios:
+                print(f"Error: Unknown scenario: {name}")
+                sys.exit(1)
+    elif opt == "--latency":
+        latency = float(arg)
+    elif opt == "--mb-rate":
+        mb_rate = float(arg)
+    elif opt == "--error-rate":
+        error_rate = float(arg)
+    elif opt == "--args":
+        script_args = arg.split()
+    elif opt == "--save":
+        save_file = arg
+    elif opt == "--compare":
+        compare_file = arg
+    elif opt == "--tolerance":
+        tolerance = float(arg)
+    elif opt == "--output":
+        output_file = arg
+    elif opt == "--help":
+        help_doc()
+
+def run_scenario(name, albums):
+    # Run the script once against a new library and collect the numbers from both sides
+    server, library, stats = fake_servers.serve(albums, 0, latency, mb_rate, error_rate)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    env = dict(os.environ, JELLYFIN_SERVER=url, MUSICBRAINZ_SERVER=f"{url}/ws/2", JELLYFIN_API_KEY="benchmark")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        command = [sys.executable, script] + scenarios[name](albums) + [f"--cache-dir={cache_dir}"] + script_args
+        output = open(output_file, "a") if output_file != None else subprocess.DEVNULL
+        started = time.monotonic()
+        # A new session has no terminal so the password is read from stdin
+        process = subprocess.run(command, input="benchmark\nbenchmark\n", text=True, env=env, stdout=output, stderr=subprocess.STDOUT, start_new_session=True)
+        seconds = time.monotonic() - started
+        if output_file != None:
+            output.close()
+        report = {}
+        report_path = os.path.join(cache_dir, "run_report.json")
+        if os.path.exists(report_path):
+            with open(report_path) as report_file:
+                report = json.load(report_file)
+    server.shutdown()
+    server.server_close()
+    if process.returncode != 0:
+        print(f"Error: {name} with {albums} albums exited with {process.returncode}, use --output to see what happened")
+
+    tracks = sum(library.discs(number) for number in range(albums)) * fake_servers.TRACKS_PER_DISC
+    items = tracks if name == "shuffle" else albums
+    requests = {}
+    for endpoint in report.get("endpoints", {}).values():
+        requests[endpoint["backend"]] = requests.get(endpoint["backend"], 0) + endpoint["requests"]
+    return {
+        "scenario": name,
+        "albums": albums,
+        "exit": process.returncode,
+        "seconds": round(seconds, 2),
+        "items": items,
+        "items_per_second": round(items / seconds, 1),
+        "writes": stats.writes,
+        "jellyfin_requests": requests.get("jellyfin", 0),
+        "musicbrainz_requests": requests.get("musicbrainz", 0),
+        "server_bytes": stats.bytes,
+        "server_requests": dict(stats.requests)
+    }
+
+def print_results(results):
+    print(f"{'scenario':10} {'albums':>8} {'seconds':>9} {'items/s':>10} {'writes':>8} {'jellyfin':>9} {'musicbrainz':>12} {'MB sent':>8}")
+    for result in results:
+        print(f"{result['scenario']:10} {result['albums']:8} {result['seconds']:9} {result['items_per_second']:10} {result['writes']:8} {result['jellyfin_requests']:9} {result['musicbrainz_requests']:12} {result['server_bytes'] / 1048576:8.1f}")
+    print("items are albums for all and genre and playlist tracks for shuffle")
+
+def compare_results(results, baseline):
+    # Returns the scenarios that got slower or sent more requests than the saved results
+    regressions = []
+    saved = {(result["scenario"], result["albums"]): result for result in baseline}
+    for result in results:
+        before = saved.get((result["scenario"], result["albums"]))
+        if before == None:
+            continue
+        change = result["items_per_second"] / before["items_per_second"] - 1
+        print(f"{result['scenario']} {result['albums']}: {before['items_per_second']} -> {result['items_per_second']} items/s ({change:+.0%})")
+        if change < -tolerance:
+            regressions.append(f"{result['scenario']} {result['albums']} is {-change:.0%} slower")
+        for key in ("jellyfin_requests", "musicbrainz_requests"):
+            if result[key] > before[key]:
+                regressions.append(f"{result['scenario']} {result['albums']} sent {result[key]} {key.replace('_', ' ')}, was {before[key]}")
+    return regressions
+
+results = []
+for albums in album_counts:
+    for name in scenario_names:
+        print(f"Running {name} with {albums} albums")
+        results.append(run_scenario(name, albums))
+print_results(results)
+
+if save_file != None:
+    with open(save_file, "w") as saved:
+        json.dump(results, saved, indent=1)
+
+failed = any(result["exit"] != 0 for result in results)
+if compare_file != None:
+    with open(compare_file) as saved:
+        regressions = compare_results(results, json.load(saved))
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    failed = failed or len(regressions) > 0
+sys.exit(1 if failed else 0)
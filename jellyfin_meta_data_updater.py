@@ -22,12 +22,35 @@
 
 
 import requests
+import requests.adapters
+import urllib3.exceptions
 import json
 import os
 import sys
 import getpass
 import getopt
 import time
+import threading
+import atexit
+import sqlite3
+import zlib
+import fcntl
+import glob
+import email.utils
+import concurrent.futures
+import collections
+import tarfile
+import queue
+import re
+import bisect
+import contextlib
+import urllib.parse
+import hashlib
+import unicodedata
+import socket
+import copy
+import traceback
+import signal
 from random import shuffle
 
 # Settings, You will need to change these to match your setup
@@ -39,89 +62,314 @@ script_version = "0.5"
 script_name = "jellyfin_meta_data_updater.py"
 
 jellyfin_meta = "&SortBy=IndexNumber&mediaTypes=Audio"
-jellyfin_metas = [
-    "&Fields=ProviderIds",
-    ",Genres",
-    ",Tags",
-    ",Studios",
-    ",ParentId",
-    ",MediaSources"
-]
-for meta in jellyfin_metas:
-    jellyfin_meta += meta
+# Fields requested from jellyfin for each operation, each one only asks for what that operation reads
+# Images and user data are never used so they are not requested
+jellyfin_profiles = {
+    # Tracks updated with musicbrainz track ids, the path is used to find multi disc albums and for --sort-alpha
+    # Tags are only read to check if an update would change the track
+    "trackid": "ProviderIds,Genres,Tags,Studios,ParentId,Path",
+    # Albums read to find their musicbrainz ids when updating track ids
+    "album-ids": "ProviderIds",
+    # Albums updated with genres, this is everything that is sent back when updating an album
+    "genre": "ProviderIds,Genres,Tags,Studios,ParentId",
+    # Playlist items, only the ids are used
+    "shuffle": "",
+    # Disc folders read to check how an album is stored
+    "verify": "ParentId"
+}
 musicbrainz_server = "https://musicbrainz.org/ws/2"
+# The servers and api key can also be set with environment variables, eg: to run against the benchmark servers
+jellyfin_server = os.environ.get("JELLYFIN_SERVER", jellyfin_server)
+jellyfin_api_key = os.environ.get("JELLYFIN_API_KEY", jellyfin_api_key)
+musicbrainz_server = os.environ.get("MUSICBRAINZ_SERVER", musicbrainz_server)
+# Jellyfin login used instead of asking when there is no saved session or it has expired, eg: for cron jobs
+jellyfin_username = os.environ.get("JELLYFIN_USERNAME")
+jellyfin_password = os.environ.get("JELLYFIN_PASSWORD")
 
+# Number of albums requested at a time when processing all albums
+album_page_size = 500
+# Number of playlist items requested at a time when reading a playlist
+playlist_page_size = 1000
+# Number of tracks sent in each request when creating a playlist, the first batch creates the playlist and the rest are added to it
+playlist_batch_size = 200
+# Read the tracks for a batch of albums with a few large requests when processing all albums, instead of one request per album
+use_track_index = True
+# Number of tracks requested at a time when building the track index
+track_page_size = 2000
+# Number of albums whose tracks are read together for the track index
+track_index_batch_size = 100
 
-# Make sure the script is run with the correct arguments
-if len(sys.argv) < 2:
-    print("Usage: jellyfin_meta_data_updater.py [<musicbrainz_album_id> | all] [--dry-run] [--use-musicbrainz-metadata] [--verify-off] [--skip-existing] [--merge <album_id>] [--sort-alpha] [--help] [shuffle=<new_playlist_name> [start=<start_track_number>]] [--genre [count=<vote_count>]]")
-    sys.exit(1)
+# HTTP client settings, connections are kept alive and reused for every request to the same backend
+# Maximum number of pooled connections per backend
+http_pool_size = 10
+# Seconds to wait for the server to connect and respond
+http_timeout = 30
+# Requests per second and burst size for each backend, a rate of 0 means no limit
+# Musicbrainz allows an average of 1 request per second, https://musicbrainz.org/doc/MusicBrainz_API/Rate_Limiting
+rate_limits = {
+    "jellyfin": [0, 10],
+    "musicbrainz": [1.0, 1]
+}
+# Number of times a request is retried after a 429/503 response or a connection error
+http_retries = 5
+# Jellyfin item updates are sent from a queue in the background so processing does not wait for each write
+use_write_queue = True
+# Maximum number of updates sent to jellyfin at the same time
+# The number actually used starts at 1, grows while updates are fast and halves when they are slow or fail
+write_concurrency = 8
+# Seconds an update can take before the server is considered busy
+write_latency_target = 1.0
 
-# The first argument is the jellyfin album id
-jellyfin_album_id = sys.argv[1]
-# Not impleted yet - Will run without making any changes to the jellyfin server
-dry_run = False
-# Not impleted yet - Use all musicbrainz metadata instead of jellyfin metadata
-use_musicbrainz_metadata = False
-# Verify the changes before updating the jellyfin server
-verify=True
-# Skip albums that already have musicbrainz track ids
-skip_existing = False
-# Does not work - Merge albums that have been split into multiple albums, this can be a string or comma separated list of album ids
-merge=None
-
-new_playlist_name=None
-# The track number to start the shuffle from, this is useful if you want to shuffle a playlist but start from a specific track number so that you can continue from where you left off
-start=None
-sort_alpha=False
-# Add genres to the album from musicbrainz
-update_genre=False
-count=1
-# Process optional arguments that can be in any order
-try:
-    opts, args = getopt.getopt(sys.argv[2:], "dbvsm:a", ["dry-run", "use-musicbrainz-metadata", "verify-off", "skip-existing", "merge=", "sort-alpha", "help", "shuffle=", "start=", "genre", "count="])
-except getopt.GetoptError as err:
-    print(err)
-    sys.exit(1)
+# MusicBrainz response cache, responses are kept on disk so later runs do not download them again
+cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "jellyfin_meta_data_updater")
+use_cache = True
+# Ignore cached responses and download them again, the new responses are still cached
+refresh_cache = False
+# Number of days a cached response is used for before it is downloaded again
+cache_ttl_days = {
+    "release": 30,
+    "release-group": 7,
+    "artist": 7,
+    "genre": 30
+}
+# Maximum size of the cache in MB, the least recently used responses are removed first
+cache_max_mb = 256
 
-for opt, arg in opts:
-    if opt == "--dry-run":
-        dry_run = True
-    elif opt == "--use-musicbrainz-metadata":
-        use_musicbrainz_metadata = True
-    elif opt == "--verify-off":
-        verify = False
-    elif opt == "--skip-existing":
-        skip_existing = True
-    elif opt == "--sort-alpha":
-        sort_alpha = True
-    elif opt == "--merge":
-        merge = arg
-        if merge == None:
-            print("Error: You must specify an album id to merge")
-            sys.exit(1)
-    elif opt == "--help":
-        help()
-    elif opt == "--genre":
-        update_genre=True
-    elif opt == "--count":
-        count=arg
-        if count == None:
-            print("Error: You must specify a vote count")
-            sys.exit(1)
-    elif opt == "--shuffle":
-        new_playlist_name = arg
-        if new_playlist_name == None:
-            print("Error: You must specify a new playlist name")
-            sys.exit(1)
-    elif opt == "--start":
-        start = arg
-        if start == None:
-            print("Error: You must specify a start track number")
+# Look up the release groups and artists for many albums with one musicbrainz search request when updating genres
+use_musicbrainz_batch = True
+# Number of ids in each search request
+musicbrainz_batch_size = 50
+
+# Where musicbrainz data comes from, "online" uses the musicbrainz server, "offline" uses a database built from the musicbrainz json dumps
+# https://data.metabrainz.org/pub/musicbrainz/data/json-dumps/
+musicbrainz_backend = "online"
+# Database built by musicbrainz-import, Default: musicbrainz_dump.sqlite in the cache directory
+musicbrainz_dump_db = None
+# Dump files to import with musicbrainz-import, eg: release.tar.xz, release-group.tar.xz and artist.tar.xz
+musicbrainz_dump_files = []
+
+
+def parse_args(argv):
+    # Set the options for a run from its arguments, argv is the command line without the script name
+    # Every option starts from its default so a daemon job does not keep the options of the job before it
+    global run_arguments, jellyfin_album_id, dry_run, use_musicbrainz_metadata, verify, skip_existing, merge, new_playlist_name
+    global start, shuffle_seed, shuffle_position, shuffle_window, sort_alpha, update_genre, count, min_confidence
+    global group_by_artist, workers, shard_index, shard_count, journal_file, resume, since, report_file
+    global prometheus_file, profile_run, memory_test_tracks, prefetch, daemon_socket, use_session, http_pool_size, http_timeout, cache_dir
+    global use_cache, refresh_cache, cache_max_mb, http_retries, album_page_size, musicbrainz_backend, musicbrainz_dump_db
+    global use_track_index, track_page_size, use_write_queue, write_concurrency, write_latency_target, playlist_page_size, playlist_batch_size, use_musicbrainz_batch
+    global musicbrainz_batch_size, shared_rate_backends
+    run_arguments = argv
+    # Make sure the script is run with the correct arguments
+    if len(argv) < 1:
+        print("Usage: jellyfin_meta_data_updater.py [<musicbrainz_album_id> | all] [--dry-run] [--use-musicbrainz-metadata] [--verify-off] [--skip-existing] [--merge <album_id>] [--sort-alpha] [--help] [shuffle=<new_playlist_name> [start=<start_track_number>]] [--genre [count=<vote_count>]]")
+        sys.exit(1)
+
+    # The first argument is the jellyfin album id
+    jellyfin_album_id = argv[0]
+    # Not impleted yet - Will run without making any changes to the jellyfin server
+    dry_run = False
+    # Not impleted yet - Use all musicbrainz metadata instead of jellyfin metadata
+    use_musicbrainz_metadata = False
+    # Verify the changes before updating the jellyfin server
+    verify=True
+    # Skip albums that already have musicbrainz track ids
+    skip_existing = False
+    # Does not work - Merge albums that have been split into multiple albums, this can be a string or comma separated list of album ids
+    merge=None
+
+    new_playlist_name=None
+    # The track number to start the shuffle from, this is useful if you want to shuffle a playlist but start from a specific track number so that you can continue from where you left off
+    start=None
+    # Shuffle with a permutation made from the playlist id and this seed instead of a random shuffle, the same seed always gives the same order
+    shuffle_seed=None
+    # Position in the seeded shuffle to start from, Default: the position saved by the last run with the same playlist and seed
+    shuffle_position=None
+    # Number of tracks added to the new playlist when using a seed, Default: every track from the position to the end
+    shuffle_window=None
+    sort_alpha=False
+    # Add genres to the album from musicbrainz
+    update_genre=False
+    count=1
+    # Tracks matched to musicbrainz with a lower confidence than this are shown for review and not updated
+    min_confidence=0.5
+    # Process the albums of each artist together when using all --genre, each artist's genres are only looked up once
+    group_by_artist=False
+    # Number of albums processed at the same time when using all, requires --verify-off
+    workers=1
+    # Process only part of the albums when using all, shard 2 of 4 is --shard=2/4
+    # Shards can run at the same time from different processes, they share the musicbrainz rate limit
+    shard_index=1
+    shard_count=1
+    # Journal of album results for all runs, used to resume a run that did not finish, Default: journal.jsonl in the cache directory
+    journal_file=None
+    # Skip albums that were finished by the last run that did not complete
+    resume=False
+    # Only process albums added or changed since the last run that completed
+    since=False
+    # JSON report of the requests and time spent in each step, written at the end of the run, Default: run_report.json in the cache directory
+    report_file=None
+    # Prometheus textfile collector file the same numbers are written to
+    prometheus_file=None
+    # Sample what every thread is doing while the script runs and show where the time went at the end
+    profile_run=False
+    # Number of synthetic tracks used by track-memory
+    memory_test_tracks=1000000
+    # Number of albums prepared in the background while waiting for confirmation when using all
+    prefetch=0
+    # Unix socket the daemon listens on for jobs, Default: daemon.sock in the cache directory
+    daemon_socket=None
+    # Save the jellyfin login in the cache directory and use it again until it expires
+    use_session=True
+    # Process optional arguments that can be in any order
+    try:
+        opts, args = getopt.getopt(argv[1:], "dbvsm:a", ["dry-run", "use-musicbrainz-metadata", "verify-off", "skip-existing", "merge=", "sort-alpha", "help", "shuffle=", "start=", "genre", "count=", "pool-size=", "timeout=", "cache-dir=", "no-cache", "refresh", "cache-size=", "mb-rate=", "mb-burst=", "jf-rate=", "jf-burst=", "retries=", "page-size=", "workers=", "prefetch=", "journal=", "resume", "since", "musicbrainz-backend=", "musicbrainz-db=", "dump=", "no-track-index", "track-page-size=", "no-write-queue", "write-concurrency=", "write-latency=", "playlist-page-size=", "playlist-batch-size=", "seed=", "position=", "window=", "min-confidence=", "tracks=", "report=", "prometheus=", "profile", "group-by-artist", "no-batch", "batch-size=", "shard=", "socket=", "no-session"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(1)
+
+    for opt, arg in opts:
+        if opt == "--dry-run":
+            dry_run = True
+        elif opt == "--use-musicbrainz-metadata":
+            use_musicbrainz_metadata = True
+        elif opt == "--verify-off":
+            verify = False
+        elif opt == "--skip-existing":
+            skip_existing = True
+        elif opt == "--sort-alpha":
+            sort_alpha = True
+        elif opt == "--merge":
+            merge = arg
+            if merge == None:
+                print("Error: You must specify an album id to merge")
+                sys.exit(1)
+        elif opt == "--help":
+            help()
+        elif opt == "--genre":
+            update_genre=True
+        elif opt == "--count":
+            count=arg
+            if count == None:
+                print("Error: You must specify a vote count")
+                sys.exit(1)
+        elif opt == "--pool-size":
+            http_pool_size = int(arg)
+        elif opt == "--timeout":
+            http_timeout = float(arg)
+        elif opt == "--cache-dir":
+            cache_dir = arg
+        elif opt == "--no-cache":
+            use_cache = False
+        elif opt == "--refresh":
+            refresh_cache = True
+        elif opt == "--cache-size":
+            cache_max_mb = int(arg)
+        elif opt == "--mb-rate":
+            rate_limits["musicbrainz"][0] = float(arg)
+        elif opt == "--mb-burst":
+            rate_limits["musicbrainz"][1] = int(arg)
+        elif opt == "--jf-rate":
+            rate_limits["jellyfin"][0] = float(arg)
+        elif opt == "--jf-burst":
+            rate_limits["jellyfin"][1] = int(arg)
+        elif opt == "--retries":
+            http_retries = int(arg)
+        elif opt == "--page-size":
+            album_page_size = int(arg)
+        elif opt == "--workers":
+            workers = int(arg)
+        elif opt == "--prefetch":
+            prefetch = int(arg)
+        elif opt == "--journal":
+            journal_file = arg
+        elif opt == "--resume":
+            resume = True
+        elif opt == "--since":
+            since = True
+        elif opt == "--musicbrainz-backend":
+            musicbrainz_backend = arg
+            if musicbrainz_backend not in ["online", "offline"]:
+                print("Error: --musicbrainz-backend must be online or offline")
+                sys.exit(1)
+        elif opt == "--musicbrainz-db":
+            musicbrainz_dump_db = arg
+        elif opt == "--dump":
+            musicbrainz_dump_files.append(arg)
+        elif opt == "--no-track-index":
+            use_track_index = False
+        elif opt == "--track-page-size":
+            track_page_size = int(arg)
+        elif opt == "--no-write-queue":
+            use_write_queue = False
+        elif opt == "--write-concurrency":
+            write_concurrency = int(arg)
+        elif opt == "--write-latency":
+            write_latency_target = float(arg)
+        elif opt == "--playlist-page-size":
+            playlist_page_size = int(arg)
+        elif opt == "--playlist-batch-size":
+            playlist_batch_size = int(arg)
+        elif opt == "--seed":
+            shuffle_seed = arg
+        elif opt == "--position":
+            shuffle_position = int(arg)
+        elif opt == "--window":
+            shuffle_window = int(arg)
+        elif opt == "--min-confidence":
+            min_confidence = float(arg)
+        elif opt == "--tracks":
+            memory_test_tracks = int(arg)
+        elif opt == "--report":
+            report_file = arg
+        elif opt == "--prometheus":
+            prometheus_file = arg
+        elif opt == "--profile":
+            profile_run = True
+        elif opt == "--group-by-artist":
+            group_by_artist = True
+        elif opt == "--no-batch":
+            use_musicbrainz_batch = False
+        elif opt == "--batch-size":
+            musicbrainz_batch_size = int(arg)
+        elif opt == "--shard":
+            try:
+                shard_index, shard_count = [int(part) for part in arg.split("/")]
+            except ValueError:
+                shard_count = 0
+            if shard_count < 1 or not 1 <= shard_index <= shard_count:
+                print("Error: --shard must be <shard>/<number of shards>, eg: --shard=2/4")
+                sys.exit(1)
+        elif opt == "--socket":
+            daemon_socket = arg
+        elif opt == "--no-session":
+            use_session = False
+        elif opt == "--shuffle":
+            new_playlist_name = arg
+            if new_playlist_name == None:
+                print("Error: You must specify a new playlist name")
+                sys.exit(1)
+        elif opt == "--start":
+            start = arg
+            if start == None:
+                print("Error: You must specify a start track number")
+                sys.exit(1)
+        else:
+            print("Usage: jellyfin_meta_data_updater.py [<musicbrainz_album_id> | all] [--dry-run] [--use-musicbrainz-metadata] [--verify-off] [--skip-existing] [--merge <album_id>] [--sort-alpha] [--help] [shuffle=<new_playlist_id> [start=<start_track_id>]] [--genre [count=<vote_count>]]")
             sys.exit(1)
-    else:
-        print("Usage: jellyfin_meta_data_updater.py [<musicbrainz_album_id> | all] [--dry-run] [--use-musicbrainz-metadata] [--verify-off] [--skip-existing] [--merge <album_id>] [--sort-alpha] [--help] [shuffle=<new_playlist_id> [start=<start_track_id>]] [--genre [count=<vote_count>]]")
+
+    if shard_count > 1 and jellyfin_album_id != "all":
+        print("Error: --shard can only be used with all")
+        sys.exit(1)
+    if workers > 1 and verify and not update_genre:
+        print("Error: --workers can only be used with --verify-off or --genre")
         sys.exit(1)
+    # Every worker and writer needs its own connection
+    http_pool_size = max(http_pool_size, workers + write_concurrency, prefetch + 1 + write_concurrency)
+    # Shards share the buckets of the backends that have a rate limit
+    shared_rate_backends = [backend for backend, limit in rate_limits.items() if limit[0] > 0] if shard_count > 1 else []
+    if jellyfin_album_id == "--help":
+        help_doc()
 
 def help_doc():
     print("Usage: jellyfin_meta_data_updater.py [<musicbrainz_album_id> | all] [--dry-run] [--use-musicbrainz-metadata] [--verify-off] [--skip-existing] [--merge <album_id>] [--sort-alpha] [--help] [shuffle=<new_playlist_name> [start=<start_track_id>]]")
@@ -134,46 +382,1070 @@ def help_doc():
     print("You can update the genres for an album from musicbrainz with the --genre option, eg: jellyfin_meta_data_updater.py <musicbrainz_album_id> --genre")
     print("You can specify a minimum vote count for the genres with the --count option, eg: jellyfin_meta_data_updater.py <musicbrainz_album_id> --genre --count=2")
     print("\"all\" can be used with the --genre option to update all albums, eg: jellyfin_meta_data_updater.py all --genre")
+    print("--no-batch: Look up each release group and artist on its own when using all --genre instead of searching for many at once")
+    print("--batch-size: Number of release groups or artists in each musicbrainz search when using all --genre (Default: 50)")
+    print("--shard: Process one part of the albums when using all, eg: --shard=2/4. Run every shard at the same time to use more of the jellyfin server, they share the musicbrainz rate limit")
+    print("         Each shard keeps its own journal and results, merge-shards combines the results, eg: jellyfin_meta_data_updater.py merge-shards")
+    print("--group-by-artist: Update the genres of each artist's albums together when using all --genre, the albums are listed in album artist order and --workers works on different artists")
+    print("--pool-size: Number of keep-alive connections kept open to each server (Default: 10)")
+    print("--timeout: Seconds to wait for a server to respond before giving up (Default: 30)")
+    print(f"--cache-dir: Directory used to cache musicbrainz responses between runs (Default: {cache_dir})")
+    print("--no-cache: Do not read or write the musicbrainz cache")
+    print("--refresh: Download musicbrainz responses again even if they are cached")
+    print("--cache-size: Maximum size of the musicbrainz cache in MB, least recently used responses are removed first (Default: 256)")
+    print("--mb-rate, --mb-burst: Musicbrainz requests per second and how many can be sent at once (Default: 1, 1)")
+    print("--jf-rate, --jf-burst: Jellyfin requests per second and how many can be sent at once, a rate of 0 is unlimited (Default: 0, 10)")
+    print("--page-size: Number of albums to request from jellyfin at a time when using all (Default: 500)")
+    print("--workers: Number of albums to process at the same time when using all, requires --verify-off unless used with --genre (Default: 1)")
+    print("--prefetch: Number of albums to get ready in the background while waiting for confirmation when using all, confirmed albums are updated in the background (Default: 0)")
+    print("--journal: File the result of each album is written to when using all (Default: journal.jsonl in the cache directory, journal.shard-<shard>-of-<number of shards>.jsonl with --shard)")
+    print("--resume: Skip albums finished by the last all run that did not complete, eg: jellyfin_meta_data_updater.py all --genre --resume")
+    print("--since: Only process albums added or changed since the last all run that completed")
+    print("--musicbrainz-backend: Use online for the musicbrainz server or offline for a database built from the musicbrainz json dumps (Default: online)")
+    print("--musicbrainz-db: Database used by the offline musicbrainz backend (Default: musicbrainz_dump.sqlite in the cache directory)")
+    print("You can build the offline musicbrainz database from the json dumps with musicbrainz-import, eg: jellyfin_meta_data_updater.py musicbrainz-import --dump=release.tar.xz --dump=release-group.tar.xz --dump=artist.tar.xz")
+    print("--no-track-index: Read the tracks for each album when it is processed instead of reading the tracks of 100 albums at a time when using all")
+    print("--track-page-size: Number of tracks requested at a time when building the track index (Default: 2000)")
+    print("--no-write-queue: Send each update to jellyfin and wait for it to finish before continuing")
+    print("--write-concurrency: Maximum number of updates sent to jellyfin at the same time, the number used adapts to how fast jellyfin responds (Default: 8)")
+    print("--write-latency: Seconds an update can take before jellyfin is considered busy and fewer updates are sent at once (Default: 1)")
+    print("--playlist-page-size: Number of playlist items read at a time when shuffling (Default: 1000)")
+    print("--playlist-batch-size: Number of tracks added at a time when creating the shuffled playlist (Default: 200)")
+    print("You can see how much memory the tracks of a large library use with track-memory, eg: jellyfin_meta_data_updater.py track-memory --tracks=1000000")
+    print("--min-confidence: Tracks are matched to musicbrainz by title, length and track number, matches with a lower score than this between 0 and 1 are listed for review and not updated (Default: 0.5)")
+    print("--seed: Shuffle the playlist in an order made from the playlist id and the seed, the same seed always gives the same order and the next run carries on from where the last one stopped, eg: jellyfin_meta_data_updater.py <playlist_id_to_shuffle> shuffle=<new_playlist_name> --seed=1 --window=100")
+    print("--window: Number of tracks to add to the new playlist when using --seed (Default: the rest of the playlist)")
+    print("--position: Position in the seeded order to start from instead of the saved position, 0 starts from the beginning")
+    print("--report: File the run report is written to, it has the requests to each endpoint with their latency, size, status codes and retries and the time spent fetching, matching, waiting for confirmation and writing (Default: run_report.json in the cache directory)")
+    print("--prometheus: Also write the run report to a file for the prometheus node exporter textfile collector, eg: --prometheus=/var/lib/node_exporter/jellyfin_meta_data_updater.prom")
+    print("--profile: Show which functions the time was spent in at the end of the run")
+    print("--retries: Number of times to retry a request when the server is busy or the connection fails (Default: 5)")
+    print("You can log in once and keep the connections and caches ready between runs with daemon, eg: jellyfin_meta_data_updater.py daemon")
+    print("Then send it runs with submit, eg: jellyfin_meta_data_updater.py submit <musicbrainz_album_id> --genre. The output is shown and confirmations are answered as if the run was started from the terminal")
+    print("The jellyfin login is saved in session.json in the cache directory and used again until jellyfin no longer accepts it, set JELLYFIN_USERNAME and JELLYFIN_PASSWORD to log in without being asked, eg: for cron jobs")
+    print("--no-session: Log in without using or saving the saved login")
+    print("--socket: Unix socket the daemon listens on and submit sends runs to (Default: daemon.sock in the cache directory)")
     sys.exit(1)
 
-if jellyfin_album_id == "--help":
-    help_doc()
+def cache_file(name, extension):
+    # Path of a file in the cache directory, each shard has its own copy
+    if shard_count > 1:
+        return os.path.join(cache_dir, f"{name}.shard-{shard_index}-of-{shard_count}.{extension}")
+    return os.path.join(cache_dir, f"{name}.{extension}")
 
-def get_playlist(jellyfin_server, jellyfin_playlist_id):
-    # Placeholder
-    # A function to get a playlist from the jellyfin server
-    headers = {
+# Counters printed at the end of the run
+run_stats = {}
+run_stats_lock = threading.Lock()
+
+def stat_add(name, amount=1):
+    with run_stats_lock:
+        run_stats[name] = run_stats.get(name, 0) + amount
+
+# Functions called before the statistics are printed so they can add their own
+run_stats_hooks = []
+
+def print_run_stats():
+    for hook in run_stats_hooks:
+        hook()
+    if len(run_stats) == 0:
+        return
+    print("Run statistics:")
+    for name in sorted(run_stats):
+        value = run_stats[name]
+        if type(value) == float:
+            value = round(value, 2)
+        print(f"  {name}: {value}")
+
+atexit.register(print_run_stats)
+
+# Shared HTTP client layer, every request to jellyfin and musicbrainz goes through http_request
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+# Headers sent with every request to a backend
+http_backend_headers = {
+    "jellyfin": {},
+    "musicbrainz": {
+        "Accept": "application/json",
+        "User-Agent": f"{script_name}/{script_version} ( {script_contact} )"
+    }
+}
+# Prebuilt jellyfin headers, "api" uses the api key and "user" uses the token from jellyfin_auth_by_user
+jellyfin_headers = {
+    "api": {
+        "x-emby-token": jellyfin_api_key
+    },
+    "user": {
         "x-emby-authorization": f"MediaBrowser Client=\"{script_name}\", Device=\"{script_name}\", DeviceId=\"{script_name}\", Version=\"{script_version}\"",
     }
-    headers['x-mediabrowser-token'] = tokens[0]
-    url = f"{jellyfin_server}/Playlists/{jellyfin_playlist_id}/Items?userId={tokens[1]}"
-    response = requests.get(url, headers=headers)
+}
+
+def http_session(backend):
+    # Return the keep-alive session for the backend, the session is created on first use
+    with http_sessions_lock:
+        if backend not in http_sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=http_pool_size, pool_maxsize=http_pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(http_backend_headers[backend])
+            http_sessions[backend] = session
+        return http_sessions[backend]
+
+# Token bucket state for each backend, shared by every thread
+rate_buckets = {}
+rate_buckets_lock = threading.Lock()
+
+# Backends whose bucket is shared with the other shard processes, it is kept in a locked file in the cache directory
+# Set by parse_args when using --shard
+shared_rate_backends = []
+
+@contextlib.contextmanager
+def rate_limit_shared_buckets():
+    # Lock the shared bucket file, the buckets are written back when the block ends
+    # The caller holds rate_buckets_lock so only one thread in each process waits for the file lock
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, "rate_limits.json"), "a+") as shared_file:
+        fcntl.flock(shared_file, fcntl.LOCK_EX)
+        shared_file.seek(0)
+        try:
+            buckets = json.loads(shared_file.read())
+        except ValueError:
+            buckets = {}
+        if type(buckets) != dict:
+            buckets = {}
+        yield buckets
+        shared_file.seek(0)
+        shared_file.truncate()
+        shared_file.write(json.dumps(buckets))
+        shared_file.flush()
+
+def rate_limit_shared_bucket(buckets, backend, burst, now):
+    # Return the backend's bucket from the shared file, a missing or damaged bucket starts again full
+    # Another shard may have been killed while writing the file or the file may have been deleted
+    bucket = buckets.get(backend)
+    if type(bucket) != dict:
+        bucket = {}
+    for key, value in {"tokens": burst, "updated": now, "blocked_until": 0}.items():
+        if type(bucket.get(key)) not in [int, float]:
+            bucket[key] = value
+    buckets[backend] = bucket
+    return bucket
+
+def rate_limit_take(bucket, rate, burst, now):
+    # Take a token from the bucket and return the seconds to wait before using it
+    wait = max(0, bucket["blocked_until"] - now)
+    if rate > 0:
+        bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"]) * rate)
+        bucket["updated"] = now
+        # The token is taken straight away, a negative balance reserves a later slot for this request
+        bucket["tokens"] -= 1
+        if bucket["tokens"] < 0:
+            wait = max(wait, -bucket["tokens"] / rate)
+    return wait
+
+def rate_limit_wait(backend):
+    # Take a token from the backend's bucket, sleeping until one is available
+    rate, burst = rate_limits[backend]
+    with rate_buckets_lock:
+        now = time.monotonic()
+        bucket = rate_buckets.setdefault(backend, {"tokens": burst, "updated": now, "blocked_until": 0, "first": now, "requests": 0})
+        bucket["requests"] += 1
+        if backend in shared_rate_backends:
+            # Shared buckets use the wall clock because the monotonic clock is not the same in every process
+            with rate_limit_shared_buckets() as buckets:
+                now = time.time()
+                wait = rate_limit_take(rate_limit_shared_bucket(buckets, backend, burst, now), rate, burst, now)
+        else:
+            wait = rate_limit_take(bucket, rate, burst, now)
+    if wait > 0:
+        stat_add(f"{backend} rate limit wait seconds", wait)
+        time.sleep(wait)
+
+def rate_limit_block(backend, seconds):
+    # Stop every request to the backend for a while, used when the server asks us to slow down
+    with rate_buckets_lock:
+        if backend in shared_rate_backends:
+            with rate_limit_shared_buckets() as buckets:
+                bucket = rate_limit_shared_bucket(buckets, backend, rate_limits[backend][1], time.time())
+                bucket["blocked_until"] = max(bucket["blocked_until"], time.time() + seconds)
+            return
+        bucket = rate_buckets[backend]
+        bucket["blocked_until"] = max(bucket["blocked_until"], time.monotonic() + seconds)
+
+def retry_after_seconds(response, attempt):
+    # Use the Retry-After header if the server sent one, otherwise back off exponentially
+    retry_after = response.headers.get("Retry-After") if response != None else None
+    if retry_after != None:
+        if retry_after.isdigit():
+            return int(retry_after)
+        try:
+            return max(0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return min(60, 2 ** attempt)
+
+def rate_limit_stats():
+    # Show how close each backend ran to its allowed rate
+    with rate_buckets_lock:
+        for backend, bucket in rate_buckets.items():
+            if bucket["requests"] == 0:
+                continue
+            elapsed = time.monotonic() - bucket["first"]
+            run_stats[f"{backend} requests"] = bucket["requests"]
+            if rate_limits[backend][0] > 0 and elapsed > 0:
+                run_stats[f"{backend} requests per second (limit {rate_limits[backend][0]})"] = bucket["requests"] / elapsed
+
+run_stats_hooks.append(rate_limit_stats)
+
+# Request and step instrumentation, written to the run report at the end of the run
+# Upper bounds in seconds of the request latency histogram
+metrics_latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+metrics_endpoints = {}
+metrics_phases = {}
+metrics_lock = threading.Lock()
+metrics_started = time.time()
+
+def metrics_endpoint(backend, method, url):
+    # Ids in the path are replaced so the requests for every album are grouped together
+    path = urllib.parse.urlsplit(url).path
+    path = re.sub(r"/([0-9a-fA-F]{32}|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})(?=/|$)", "/{id}", path)
+    key = f"{backend} {method} {path}"
+    with metrics_lock:
+        if key not in metrics_endpoints:
+            metrics_endpoints[key] = {"backend": backend, "method": method, "path": path, "requests": 0, "errors": 0, "retries": 0,
+                                      "bytes_sent": 0, "bytes_received": 0, "statuses": {}, "seconds": 0.0, "max_seconds": 0.0,
+                                      "buckets": [0] * (len(metrics_latency_buckets) + 1)}
+        return metrics_endpoints[key]
+
+def metrics_request(backend, method, url, seconds, response=None, retry=False):
+    # Record one request, response is None when the connection failed
+    endpoint = metrics_endpoint(backend, method, url)
+    with metrics_lock:
+        endpoint["requests"] += 1
+        endpoint["seconds"] += seconds
+        endpoint["max_seconds"] = max(endpoint["max_seconds"], seconds)
+        endpoint["buckets"][bisect.bisect_left(metrics_latency_buckets, seconds)] += 1
+        if retry:
+            endpoint["retries"] += 1
+        if response == None:
+            endpoint["errors"] += 1
+            return
+        status = str(response.status_code)
+        endpoint["statuses"][status] = endpoint["statuses"].get(status, 0) + 1
+        endpoint["bytes_received"] += len(response.content)
+        if response.request.body != None:
+            endpoint["bytes_sent"] += len(response.request.body)
+
+def phase_add(name, seconds):
+    with metrics_lock:
+        phase = metrics_phases.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+        phase["count"] += 1
+        phase["seconds"] += seconds
+        phase["max_seconds"] = max(phase["max_seconds"], seconds)
+
+@contextlib.contextmanager
+def phase_timer(name):
+    # Time a step of processing an album: fetch, match, verify-wait or write
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        phase_add(name, time.monotonic() - started)
+
+def metrics_waiting():
+    # Seconds spent waiting on each server and on the person confirming albums
+    # Requests sent at the same time are all counted so the totals can be more than the length of the run
+    waiting = {"jellyfin": 0.0, "musicbrainz": 0.0, "operator": 0.0}
+    for endpoint in metrics_endpoints.values():
+        waiting[endpoint["backend"]] += endpoint["seconds"]
+    for backend in ("jellyfin", "musicbrainz"):
+        waiting[backend] += run_stats.get(f"{backend} rate limit wait seconds", 0)
+    waiting["operator"] += metrics_phases.get("verify-wait", {}).get("seconds", 0)
+    return waiting
+
+# Sampling profiler for --profile, the stack of every thread is looked at every profile_interval seconds
+profile_interval = 0.005
+profile_own = collections.Counter()
+profile_total = collections.Counter()
+profile_samples = 0
+profile_stop = threading.Event()
+
+def profile_sampler():
+    global profile_samples
+    sampler = threading.get_ident()
+    while not profile_stop.wait(profile_interval):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler or profile_idle(frame):
+                continue
+            profile_samples += 1
+            profile_own[profile_function(frame)] += 1
+            # A function that is in the stack more than once is only counted once
+            seen = set()
+            while frame != None:
+                seen.add(profile_function(frame))
+                frame = frame.f_back
+            profile_total.update(seen)
+
+def profile_idle(frame):
+    # Worker threads waiting for their next job are not counted
+    if frame.f_code.co_name == "_worker" and frame.f_code.co_filename.endswith("thread.py"):
+        return True
+    caller = frame.f_back
+    return frame.f_code.co_name == "wait" and caller != None and caller.f_code.co_name == "get" and caller.f_code.co_filename.endswith("queue.py")
+
+def profile_function(frame):
+    return f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})"
+
+def profile_report(limit=25):
+    # The functions that the most samples were taken in, including the functions they called
+    return [{"function": function, "total_percent": round(100 * samples / profile_samples, 1),
+             "own_percent": round(100 * profile_own[function] / profile_samples, 1)}
+            for function, samples in profile_total.most_common(limit)]
+
+def run_report():
+    waiting = metrics_waiting()
+    report = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(metrics_started)),
+        "seconds": round(time.time() - metrics_started, 3),
+        "arguments": run_arguments,
+        "latency_buckets": metrics_latency_buckets,
+        "endpoints": metrics_endpoints,
+        "phases": metrics_phases,
+        "waiting_seconds": waiting,
+        "most_waiting_on": max(waiting, key=waiting.get),
+        "stats": run_stats
+    }
+    if profile_run and profile_samples > 0:
+        report["profile"] = profile_report(100)
+    return report
+
+def prometheus_labels(labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+def prometheus_text(report):
+    # Prometheus text format, histogram buckets are cumulative
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP jellyfin_updater_{name} {help_text}")
+        lines.append(f"# TYPE jellyfin_updater_{name} {kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"jellyfin_updater_{name}{suffix}{prometheus_labels(labels)} {value}")
+    endpoints = list(report["endpoints"].values())
+    def label(endpoint, **extra):
+        return dict({"backend": endpoint["backend"], "method": endpoint["method"], "endpoint": endpoint["path"]}, **extra)
+    metric("requests_total", "counter", "Requests sent", [("", label(endpoint, status=status), count) for endpoint in endpoints for status, count in endpoint["statuses"].items()])
+    metric("request_errors_total", "counter", "Requests that failed to connect", [("", label(endpoint), endpoint["errors"]) for endpoint in endpoints])
+    metric("request_retries_total", "counter", "Requests that were retries", [("", label(endpoint), endpoint["retries"]) for endpoint in endpoints])
+    metric("received_bytes_total", "counter", "Response bytes received", [("", label(endpoint), endpoint["bytes_received"]) for endpoint in endpoints])
+    metric("sent_bytes_total", "counter", "Request bytes sent", [("", label(endpoint), endpoint["bytes_sent"]) for endpoint in endpoints])
+    samples = []
+    for endpoint in endpoints:
+        cumulative = 0
+        for bound, count in zip(metrics_latency_buckets + ["+Inf"], endpoint["buckets"]):
+            cumulative += count
+            samples.append(("_bucket", label(endpoint, le=bound), cumulative))
+        samples.append(("_sum", label(endpoint), endpoint["seconds"]))
+        samples.append(("_count", label(endpoint), endpoint["requests"]))
+    metric("request_duration_seconds", "histogram", "Request latency", samples)
+    metric("phase_seconds_total", "counter", "Seconds spent in each step of processing albums", [("", {"phase": name}, phase["seconds"]) for name, phase in report["phases"].items()])
+    metric("phase_runs_total", "counter", "Number of times each step ran", [("", {"phase": name}, phase["count"]) for name, phase in report["phases"].items()])
+    metric("waiting_seconds", "gauge", "Seconds spent waiting on each server and on confirmation", [("", {"on": name}, seconds) for name, seconds in report["waiting_seconds"].items()])
+    metric("run_seconds", "gauge", "Length of the run", [("", {}, report["seconds"])])
+    metric("last_run_timestamp_seconds", "gauge", "When the run finished", [("", {}, round(time.time()))])
+    return "\n".join(lines) + "\n"
+
+def write_file_atomic(path, text):
+    # Write to a temporary file and rename it so readers never see a partly written file
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".tmp", "w") as output:
+        output.write(text)
+    os.replace(path + ".tmp", path)
+
+def run_report_write():
+    profile_stop.set()
+    if len(metrics_endpoints) == 0:
+        return
+    report = run_report()
+    run_stats["most time waiting on"] = report["most_waiting_on"]
+    write_file_atomic(report_file or cache_file("run_report", "json"), json.dumps(report, indent=1))
+    if prometheus_file != None:
+        write_file_atomic(prometheus_file, prometheus_text(report))
+    if "profile" in report:
+        print(f"Profile, {profile_samples} samples of threads that were not idle:")
+        print("  total%  own%  function")
+        for entry in report["profile"][:25]:
+            print(f"  {entry['total_percent']:6}  {entry['own_percent']:4}  {entry['function']}")
+
+run_stats_hooks.append(run_report_write)
+
+def http_request(backend, method, url, headers=None, json_data=None, retries=None):
+    # Send a request using the pooled session for the backend
+    # Requests made with the jellyfin login are sent again with a new login if the server no longer accepts it
+    token = headers.get("x-mediabrowser-token") if headers is jellyfin_headers["user"] else None
+    response = http_send(backend, method, url, headers, json_data, retries)
+    if token != None and response.status_code == 401 and session_refresh(token):
+        response = http_send(backend, method, url, headers, json_data, retries)
+    return response
+
+def http_request_sent(err):
+    # True if the request may have reached the server before the error, a POST must not be sent twice then
+    # A connect timeout or a connection that could not be opened never sent anything
+    if isinstance(err, requests.ConnectTimeout):
+        return False
+    if isinstance(err, requests.Timeout):
+        return True
+    reason = getattr(err.args[0], "reason", None) if len(err.args) > 0 else None
+    return not isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+def http_send(backend, method, url, headers=None, json_data=None, retries=None):
+    # Requests wait for the backend's rate limit and are retried when the server is busy
+    if retries == None:
+        retries = http_retries
+    for attempt in range(retries + 1):
+        rate_limit_wait(backend)
+        response = None
+        started = time.monotonic()
+        try:
+            response = http_session(backend).request(method, url, headers=headers, json=json_data, timeout=http_timeout)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            metrics_request(backend, method, url, time.monotonic() - started, retry=attempt > 0)
+            # Retrying a POST that was sent could add the same tracks to a playlist twice
+            if attempt == retries or (method == "POST" and http_request_sent(err)):
+                raise
+            print(f"Error: {err}")
+        else:
+            metrics_request(backend, method, url, time.monotonic() - started, response, retry=attempt > 0)
+            if response.status_code not in (429, 503) or attempt == retries:
+                return response
+        delay = retry_after_seconds(response, attempt)
+        rate_limit_block(backend, delay)
+        stat_add(f"{backend} retries")
+        print(f"{backend} server is busy or unreachable, retrying in {round(delay, 1)} seconds")
+
+def jellyfin_fields(profile):
+    # Query string for the fields in a profile from jellyfin_profiles
+    return f"&Fields={jellyfin_profiles[profile]}&EnableImages=false&EnableUserData=false"
+
+def jellyfin_get(url, auth="api", profile=None):
+    # GET from the jellyfin server using either the api key or the user token
+    # The size of each response is counted against the profile it was requested with
+    response = http_request("jellyfin", "GET", url, headers=jellyfin_headers[auth])
+    if profile != None:
+        stat_add(f"jellyfin {profile} responses")
+        stat_add(f"jellyfin {profile} response bytes", len(response.content))
+    return response
+
+def jellyfin_post(url, data):
+    # POST json to the jellyfin server, requires the user token
+    return http_request("jellyfin", "POST", url, headers=jellyfin_headers["user"], json_data=data)
+
+# Write queue state, writer threads are started on the first queued update
+write_queue = queue.Queue(maxsize=1000)
+write_condition = threading.Condition()
+write_threads = []
+# Number of updates allowed at the same time, changed by write_adjust
+write_limit = 1.0
+write_in_flight = 0
+write_failures = []
+write_times = []
+# The album each thread is queueing updates for, an album is only journaled once its queued updates are sent
+write_album = threading.local()
+# Number of queued updates for each album, albums with an update that failed and journal entries waiting on updates
+write_pending = {}
+write_failed_albums = set()
+write_journal_waiting = {}
+
+@contextlib.contextmanager
+def album_writes(album_id):
+    # Count the updates queued in the block against the album
+    write_album.id = album_id
+    try:
+        yield
+    finally:
+        write_album.id = None
+
+def write_adjust(ok, latency):
+    # Additive increase, multiplicative decrease, like TCP congestion control
+    global write_limit
+    with write_condition:
+        if ok and latency <= write_latency_target:
+            write_limit = min(write_concurrency, write_limit + 1 / write_limit)
+        else:
+            write_limit = max(1.0, write_limit / 2)
+        write_condition.notify_all()
+
+def write_send(url, data):
+    # Send one update, returns True if jellyfin accepted it
+    # A busy server is retried here after the backoff, putting the update back on the full queue could block every writer
+    global write_in_flight
+    for attempt in range(http_retries + 1):
+        with write_condition:
+            while write_in_flight >= int(write_limit):
+                write_condition.wait()
+            write_in_flight += 1
+        started = time.monotonic()
+        response = None
+        try:
+            response = http_request("jellyfin", "POST", url, headers=jellyfin_headers["user"], json_data=data, retries=0)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            # Sending an item update twice leaves the item the same, so unlike playlist changes it is safe to retry
+            print(f"Error: {err}")
+        latency = time.monotonic() - started
+        with write_condition:
+            write_in_flight -= 1
+            write_times.append((started, time.monotonic()))
+        ok = response != None and response.status_code == 204
+        # Only slow down for problems caused by load, a 400 or 404 will not get better by waiting
+        busy = response == None or response.status_code == 429 or response.status_code >= 500
+        write_adjust(ok or not busy, latency)
+        if ok:
+            stat_add("jellyfin writes")
+            return True
+        if not busy or attempt == http_retries:
+            break
+        stat_add("jellyfin write retries")
+        time.sleep(retry_after_seconds(response, attempt))
+    print(f"URL: {url}")
+    if response != None:
+        print(f"Error: {response.status_code} {response.reason}")
+    write_failures.append(url)
+    return False
+
+def write_worker():
+    while True:
+        job = write_queue.get()
+        if job == None:
+            # Count the stop marker as done so the queue can be joined again when the writers are restarted
+            write_queue.task_done()
+            break
+        url, data, album_id = job
+        ok = write_send(url, data)
+        if album_id != None:
+            write_album_done(album_id, ok)
+        write_queue.task_done()
+
+def write_album_done(album_id, ok):
+    # Journal the album if this was its last queued update and the album has already finished processing
+    entry = None
+    with write_condition:
+        if not ok:
+            write_failed_albums.add(album_id)
+        write_pending[album_id] -= 1
+        if write_pending[album_id] == 0:
+            del write_pending[album_id]
+            entry = write_journal_waiting.pop(album_id, None)
+    if entry != None:
+        journal_record_written(*entry)
+
+def jellyfin_write(url, data):
+    # Update a jellyfin item, the update is queued unless the write queue is turned off
+    if not use_write_queue:
+        response = jellyfin_post(url, data)
+        if response.status_code != 204:
+            print(f"URL: {url}")
+            print(f"Error: {response.status_code} {response.reason}")
+            sys.exit(1)
+        stat_add("jellyfin writes")
+        return response
+    if len(write_threads) == 0:
+        for i in range(write_concurrency):
+            thread = threading.Thread(target=write_worker, daemon=True)
+            thread.start()
+            write_threads.append(thread)
+    album_id = getattr(write_album, "id", None)
+    if album_id != None:
+        with write_condition:
+            write_pending[album_id] = write_pending.get(album_id, 0) + 1
+    write_queue.put((url, data, album_id))
+    return None
+
+def write_queue_drain(exit_on_failure=True):
+    # Wait for every queued update to be sent
+    if len(write_threads) == 0:
+        return
+    with phase_timer("write-drain"):
+        write_queue.join()
+    for thread in write_threads:
+        write_queue.put(None)
+    for thread in write_threads:
+        thread.join()
+    write_threads.clear()
+    if len(write_times) > 0:
+        elapsed = max(end for start, end in write_times) - min(start for start, end in write_times)
+        if elapsed > 0:
+            stat_add("jellyfin writes per second", len(write_times) / elapsed)
+    if len(write_failures) > 0:
+        print(f"Error: {len(write_failures)} updates could not be sent to jellyfin:")
+        for url in write_failures:
+            print(url)
+        if exit_on_failure:
+            sys.exit(1)
+
+# Send what is still queued when the script exits early, registered once because a daemon starts the writers again for every job
+atexit.register(write_queue_drain, False)
+
+def jellyfin_set_token(access_token):
+    # Add the token from jellyfin_auth_by_user to the prebuilt user headers
+    jellyfin_headers["user"]["x-mediabrowser-token"] = access_token
+
+def musicbrainz_get(url):
+    # GET from the musicbrainz server, the User-Agent is set on the session
+    return http_request("musicbrainz", "GET", url)
+
+musicbrainz_cache_db = None
+musicbrainz_cache_lock = threading.Lock()
+# Running total of the cached body sizes, used to decide when to evict
+musicbrainz_cache_bytes = 0
+
+def musicbrainz_cache():
+    # Open the cache database on first use
+    global musicbrainz_cache_db, musicbrainz_cache_bytes
+    if musicbrainz_cache_db == None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Shards running at the same time share the cache, the timeout is how long to wait for another process's write
+        musicbrainz_cache_db = sqlite3.connect(os.path.join(cache_dir, "musicbrainz.sqlite"), check_same_thread=False, isolation_level=None, timeout=30)
+        musicbrainz_cache_db.execute("PRAGMA journal_mode=WAL")
+        musicbrainz_cache_db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, entity TEXT, body BLOB, size INTEGER, fetched REAL, accessed REAL)")
+        musicbrainz_cache_db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        musicbrainz_cache_bytes = musicbrainz_cache_db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    return musicbrainz_cache_db
+
+def musicbrainz_cache_key(entity, musicbrainz_id, inc):
+    # The same lookup always gives the same key no matter the order of the inc parameters
+    # The server is part of the key so responses from a mirror or test server are not used for another server
+    return f"{musicbrainz_server}/{entity}/{musicbrainz_id.lower()}?inc={'+'.join(sorted(inc))}"
+
+def musicbrainz_cache_get(entity, key):
+    # Return the cached response or None if it is missing or older than the ttl for the entity
+    if not use_cache or refresh_cache:
+        return None
+    with musicbrainz_cache_lock:
+        db = musicbrainz_cache()
+        row = db.execute("SELECT body, fetched FROM responses WHERE key = ?", (key,)).fetchone()
+        if row == None or time.time() - row[1] > cache_ttl_days.get(entity, 7) * 86400:
+            return None
+        db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+    return json.loads(zlib.decompress(row[0]))
+
+def musicbrainz_cache_put(entity, key, data):
+    global musicbrainz_cache_bytes
+    if not use_cache:
+        return
+    body = zlib.compress(json.dumps(data).encode())
+    now = time.time()
+    with musicbrainz_cache_lock:
+        db = musicbrainz_cache()
+        old = db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if old != None:
+            musicbrainz_cache_bytes -= old[0]
+        db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", (key, entity, body, len(body), now, now))
+        musicbrainz_cache_bytes += len(body)
+        # Remove the least recently used responses until the cache fits again
+        if musicbrainz_cache_bytes > cache_max_mb * 1024 * 1024:
+            target = cache_max_mb * 1024 * 1024 * 0.9
+            for old_key, size in db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                if musicbrainz_cache_bytes <= target:
+                    break
+                db.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                musicbrainz_cache_bytes -= size
+                stat_add("musicbrainz cache evictions")
+
+# Lookups already made during this run, so every caller asking for the same entity shares one request
+musicbrainz_memo = {}
+musicbrainz_memo_lock = threading.Lock()
+musicbrainz_memo_key_locks = {}
+# inc parameters that are always requested together, eg: the artist and genre lookups for a release group become one request
+musicbrainz_inc_groups = {
+    "release-group": ["artists", "genres"],
+    "artist": ["genres"]
+}
+
+def musicbrainz_lookup(entity, musicbrainz_id, inc):
+    # Return the entity from this run if it was already fetched with the inc parameters, otherwise fetch it once with the merged inc parameters
+    # Releases are only looked up once per album so they are not kept
+    if entity not in musicbrainz_inc_groups:
+        return musicbrainz_fetch(entity, musicbrainz_id, inc)
+    memo_key = (entity, musicbrainz_id.lower())
+    with musicbrainz_memo_lock:
+        key_lock = musicbrainz_memo_key_locks.setdefault(memo_key, threading.Lock())
+    # Callers asking for the same entity at the same time wait for the first request instead of sending their own
+    with key_lock:
+        known = musicbrainz_memo.get(memo_key)
+        if known != None and set(inc) <= known[0]:
+            stat_add("musicbrainz coalesced lookups")
+            return known[1]
+        wanted = set(inc) | set(musicbrainz_inc_groups[entity])
+        if known != None:
+            wanted |= known[0]
+        data = musicbrainz_fetch(entity, musicbrainz_id, wanted)
+        musicbrainz_memo[memo_key] = (wanted, data)
+    return data
+
+def musicbrainz_fetch(entity, musicbrainz_id, inc):
+    # Get a musicbrainz entity (release, release-group or artist) from the selected backend
+    return musicbrainz_backends[musicbrainz_backend](entity, musicbrainz_id, inc)
+
+def musicbrainz_fetch_online(entity, musicbrainz_id, inc):
+    # Get a musicbrainz entity from the musicbrainz server with the inc parameters, using the cache when possible
+    key = musicbrainz_cache_key(entity, musicbrainz_id, inc)
+    data = musicbrainz_cache_get(entity, key)
+    if data != None:
+        stat_add("musicbrainz cache hits")
+        return data
+    if use_cache:
+        stat_add("musicbrainz cache misses")
+    url = f"{musicbrainz_server}/{entity}/{musicbrainz_id}?inc={'+'.join(sorted(inc))}"
+    response = musicbrainz_get(url)
     if response.status_code != 200:
+        print(f"URL: {url}")
         print(f"Error: {response.status_code} {response.reason}")
         sys.exit(1)
-    return response.json()
+    data = response.json()
+    musicbrainz_cache_put(entity, key, data)
+    return data
+
+# Batched lookups, release groups and artists for many albums are found with one search request
+# Search results have tags instead of genres, the genres are the tags that are in the musicbrainz genre list
+musicbrainz_genre_list = None
+musicbrainz_genre_list_lock = threading.Lock()
+
+def musicbrainz_genre_names():
+    # Every genre name known to musicbrainz, cached like the other responses
+    global musicbrainz_genre_list
+    with musicbrainz_genre_list_lock:
+        if musicbrainz_genre_list == None:
+            names = musicbrainz_cache_get("genre", f"{musicbrainz_server}/genre/all")
+            if names == None:
+                url = f"{musicbrainz_server}/genre/all?fmt=txt"
+                response = musicbrainz_get(url)
+                if response.status_code != 200:
+                    print(f"URL: {url}")
+                    print(f"Error: {response.status_code} {response.reason}")
+                    sys.exit(1)
+                names = [name for name in response.text.splitlines() if name]
+                musicbrainz_cache_put("genre", f"{musicbrainz_server}/genre/all", names)
+            musicbrainz_genre_list = set(names)
+        return musicbrainz_genre_list
+
+def musicbrainz_search(entity, field, musicbrainz_ids):
+    # Search for many entities by id, one page of 100 results at a time
+    # Returns the results by id, ids the search does not find are missing
+    query = urllib.parse.quote(f"{field}:({' OR '.join(musicbrainz_ids)})")
+    results = {}
+    offset = 0
+    while True:
+        url = f"{musicbrainz_server}/{entity}?query={query}&limit=100&offset={offset}"
+        response = musicbrainz_get(url)
+        if response.status_code != 200:
+            print(f"URL: {url}")
+            print(f"Error: {response.status_code} {response.reason}")
+            sys.exit(1)
+        page = response.json()
+        items = page.get(f"{entity}s", [])
+        for item in items:
+            results[item["id"].lower()] = item
+        offset += len(items)
+        if len(items) == 0 or offset >= page.get("count", 0):
+            break
+    stat_add("musicbrainz batch searches")
+    return results
+
+def musicbrainz_search_genres(item):
+    genres = musicbrainz_genre_names()
+    return [{"name": tag["name"], "count": tag["count"]} for tag in item.get("tags", []) if tag["name"] in genres]
+
+def musicbrainz_search_cache_key(entity, musicbrainz_id):
+    # Entities rebuilt from search results have genres filtered from the tags, so they are cached apart from real lookups and only batch runs use them
+    return f"{musicbrainz_server}/search/{entity}/{musicbrainz_id.lower()}"
+
+def musicbrainz_memo_put(entity, musicbrainz_id, data):
+    # Keep an entity found by a search for the rest of the run as if it was looked up with all of its inc parameters
+    memo_key = (entity, musicbrainz_id.lower())
+    with musicbrainz_memo_lock:
+        musicbrainz_memo[memo_key] = (set(musicbrainz_inc_groups[entity]), data)
+
+def musicbrainz_batch_known(entity, musicbrainz_id):
+    # Return the entity if it is already known from this run, a cached lookup or a cached search, otherwise None
+    known = musicbrainz_memo.get((entity, musicbrainz_id))
+    if known != None:
+        return known[1]
+    data = musicbrainz_cache_get(entity, musicbrainz_cache_key(entity, musicbrainz_id, musicbrainz_inc_groups[entity]))
+    if data != None:
+        return data
+    data = musicbrainz_cache_get(entity, musicbrainz_search_cache_key(entity, musicbrainz_id))
+    if data != None:
+        # The lookup would not find the search result in the cache, so it is kept in the memo for this run
+        stat_add("musicbrainz cache hits")
+        musicbrainz_memo_put(entity, musicbrainz_id, data)
+    return data
+
+def musicbrainz_batch_found(entity, musicbrainz_id, data):
+    musicbrainz_memo_put(entity, musicbrainz_id, data)
+    musicbrainz_cache_put(entity, musicbrainz_search_cache_key(entity, musicbrainz_id), data)
+    stat_add("musicbrainz lookups from batch searches")
+
+def musicbrainz_release_group_artist(release_group):
+    # The id of the first credited artist, or None if the release group has no artist credits
+    if len(release_group.get("artist-credit", [])) == 0:
+        return None
+    return release_group["artist-credit"][0]["artist"]["id"]
+
+def musicbrainz_batch_lookup(albums):
+    # Find the release groups of the albums and then their artists with search requests
+    # Anything the searches do not find, or find without artist credits, is looked up on its own later
+    release_group_ids = [album["ProviderIds"]["MusicBrainzReleaseGroup"].lower() for album in albums
+                         if "MusicBrainzAlbum" in album.get("ProviderIds", {}) and "MusicBrainzReleaseGroup" in album.get("ProviderIds", {})]
+    artist_ids = []
+    needed = []
+    for release_group_id in dict.fromkeys(release_group_ids):
+        release_group = musicbrainz_batch_known("release-group", release_group_id)
+        if release_group == None:
+            needed.append(release_group_id)
+        elif musicbrainz_release_group_artist(release_group) != None:
+            # Release groups that are already known still need their artists
+            artist_ids.append(musicbrainz_release_group_artist(release_group))
+    for i in range(0, len(needed), musicbrainz_batch_size):
+        found = musicbrainz_search("release-group", "rgid", needed[i:i + musicbrainz_batch_size])
+        for release_group_id, item in found.items():
+            if musicbrainz_release_group_artist(item) == None:
+                continue
+            musicbrainz_batch_found("release-group", release_group_id, {
+                "id": item["id"],
+                "title": item.get("title"),
+                "artist-credit": item["artist-credit"],
+                "genres": musicbrainz_search_genres(item)
+            })
+            artist_ids.append(musicbrainz_release_group_artist(item))
+    needed = [artist_id for artist_id in dict.fromkeys(artist_id.lower() for artist_id in artist_ids) if musicbrainz_batch_known("artist", artist_id) == None]
+    for i in range(0, len(needed), musicbrainz_batch_size):
+        found = musicbrainz_search("artist", "arid", needed[i:i + musicbrainz_batch_size])
+        for artist_id, item in found.items():
+            musicbrainz_batch_found("artist", artist_id, {
+                "id": item["id"],
+                "name": item.get("name"),
+                "genres": musicbrainz_search_genres(item)
+            })
+
+def musicbrainz_batch_albums(albums):
+    # Pass the albums through, looking up the next musicbrainz_batch_size albums before they are processed
+    batch = []
+    for album in albums:
+        batch.append(album)
+        if len(batch) >= musicbrainz_batch_size:
+            musicbrainz_batch_lookup(batch)
+            yield from batch
+            batch = []
+    if len(batch) > 0:
+        musicbrainz_batch_lookup(batch)
+        yield from batch
+
+musicbrainz_dump_connection = None
+musicbrainz_dump_lock = threading.Lock()
+
+def musicbrainz_dump_path():
+    if musicbrainz_dump_db != None:
+        return musicbrainz_dump_db
+    return os.path.join(cache_dir, "musicbrainz_dump.sqlite")
+
+def musicbrainz_dump_open():
+    global musicbrainz_dump_connection
+    if musicbrainz_dump_connection == None:
+        os.makedirs(os.path.dirname(os.path.abspath(musicbrainz_dump_path())), exist_ok=True)
+        musicbrainz_dump_connection = sqlite3.connect(musicbrainz_dump_path(), check_same_thread=False)
+        # The primary key is the index used to look up releases, release groups and artists by MBID
+        musicbrainz_dump_connection.execute("CREATE TABLE IF NOT EXISTS entities (entity TEXT, mbid TEXT, body BLOB, PRIMARY KEY (entity, mbid)) WITHOUT ROWID")
+    return musicbrainz_dump_connection
+
+def musicbrainz_dump_check():
+    # Stop before logging in if the offline backend has no database, opening it would create an empty one and every lookup would miss
+    if musicbrainz_backend != "offline" or jellyfin_album_id in local_commands:
+        return
+    if os.path.exists(musicbrainz_dump_path()):
+        with musicbrainz_dump_lock:
+            if musicbrainz_dump_open().execute("SELECT 1 FROM entities LIMIT 1").fetchone() != None:
+                return
+    print(f"Error: The offline musicbrainz database {musicbrainz_dump_path()} is missing or empty")
+    print("Import the musicbrainz json dumps first, eg: jellyfin_meta_data_updater.py musicbrainz-import --dump=release.tar.xz")
+    sys.exit(1)
+
+def musicbrainz_fetch_offline(entity, musicbrainz_id, inc):
+    # Get a musicbrainz entity from the database built from the json dumps
+    # The dumps contain every inc parameter so the response has the same shape as the musicbrainz server
+    with musicbrainz_dump_lock:
+        row = musicbrainz_dump_open().execute("SELECT body FROM entities WHERE entity = ? AND mbid = ?", (entity, musicbrainz_id.lower())).fetchone()
+    if row == None:
+        # Entities added to musicbrainz after the dump was made
+        stat_add("musicbrainz offline misses")
+        print(f"{entity} {musicbrainz_id} is not in the offline musicbrainz database, using the musicbrainz server")
+        return musicbrainz_fetch_online(entity, musicbrainz_id, inc)
+    stat_add("musicbrainz offline hits")
+    return json.loads(zlib.decompress(row[0]))
+
+musicbrainz_backends = {
+    "online": musicbrainz_fetch_online,
+    "offline": musicbrainz_fetch_offline
+}
+
+def musicbrainz_dump_entity(name):
+    # Work out the entity type from a dump file name, eg: mbdump/release-group or release-group.tar.xz
+    name = os.path.basename(name).split(".")[0]
+    if name in ["release", "release-group", "artist"]:
+        return name
+    return None
+
+def musicbrainz_dump_import_lines(db, entity, lines):
+    # Add each json line to the database, the lines are read one at a time so the dump never has to fit in memory
+    imported = 0
+    rows = []
+    for line in lines:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        musicbrainz_id = json.loads(line)["id"]
+        rows.append((entity, musicbrainz_id, zlib.compress(line)))
+        if len(rows) >= 10000:
+            db.executemany("INSERT OR REPLACE INTO entities VALUES (?, ?, ?)", rows)
+            db.commit()
+            imported += len(rows)
+            rows = []
+            if imported % 100000 == 0:
+                print(f"Imported {imported} {entity} entries")
+    db.executemany("INSERT OR REPLACE INTO entities VALUES (?, ?, ?)", rows)
+    db.commit()
+    imported += len(rows)
+    print(f"Imported {imported} {entity} entries")
+
+def musicbrainz_dump_import(dump_files):
+    # Build the offline musicbrainz database from the json dump files, either the .tar.xz files or the extracted mbdump files
+    db = musicbrainz_dump_open()
+    for dump_file in dump_files:
+        print(f"Importing: {dump_file}")
+        if tarfile.is_tarfile(dump_file):
+            # Stream the archive instead of extracting it
+            with tarfile.open(dump_file, "r|*") as archive:
+                for member in archive:
+                    entity = musicbrainz_dump_entity(member.name)
+                    if member.isfile() and entity != None and os.path.dirname(member.name) == "mbdump":
+                        musicbrainz_dump_import_lines(db, entity, archive.extractfile(member))
+        else:
+            entity = musicbrainz_dump_entity(dump_file)
+            if entity == None:
+                print(f"Error: Can not tell if {dump_file} contains releases, release groups or artists, name it release, release-group or artist")
+                sys.exit(1)
+            with open(dump_file, "rb") as lines:
+                musicbrainz_dump_import_lines(db, entity, lines)
+    print(f"Offline musicbrainz database: {musicbrainz_dump_path()}")
+
+def get_playlist(jellyfin_server, jellyfin_playlist_id):
+    # Get the items in a playlist from the jellyfin server, one page at a time
+    url = f"{jellyfin_server}/Playlists/{jellyfin_playlist_id}/Items?userId={tokens[1]}{jellyfin_fields('shuffle')}"
+    items = []
+    for page in jellyfin_get_pages(url, playlist_page_size, auth="user", profile="shuffle"):
+        items += [{"Id": item["Id"]} for item in page]
+        print(f"Read {len(items)} playlist items")
+    return {"Items": items, "TotalRecordCount": len(items)}
 
 def save_playlist(playlist_name, playlist_items):
-    # Placeholder
-    # A function to save a playlist to the jellyfin server
-    headers = {
-        "x-emby-authorization": f"MediaBrowser Client=\"{script_name}\", Device=\"{script_name}\", DeviceId=\"{script_name}\", Version=\"{script_version}\"",
-        "Content-Type": "application/json"
-    }
-    headers['x-mediabrowser-token'] = tokens[0]
+    # Create the playlist with the first batch of tracks, then add the rest in batches
+    # Large playlists in a single request time out or are larger than the server allows
     data = {
         "Name": playlist_name,
-        "Ids": playlist_items,
+        "Ids": playlist_items[:playlist_batch_size],
         "MediaType": "Audio",
         "UserId": tokens[1]
     }
     url = f"{jellyfin_server}/Playlists"
-    response = requests.post(url, headers=headers, json=data)
-    if response.status_code != 204:
+    response = jellyfin_post(url, data)
+    # The new playlist id is in the response body, so only a 200 means it can be added to
+    if response.status_code != 200:
         print(f"Error: {response.status_code} {response.reason}")
         sys.exit(1)
+    playlist_id = response.json()["Id"]
     print(f"Created playlist: {playlist_name}")
-    print(f"New playlist id: {response.json()}")
+    print(f"New playlist id: {playlist_id}")
+    for i in range(playlist_batch_size, len(playlist_items), playlist_batch_size):
+        url = f"{jellyfin_server}/Playlists/{playlist_id}/Items?userId={tokens[1]}&ids={','.join(playlist_items[i:i + playlist_batch_size])}"
+        response = jellyfin_post(url, None)
+        if response.status_code != 204:
+            print(f"URL: {url}")
+            print(f"Error: {response.status_code} {response.reason}")
+            sys.exit(1)
+        print(f"Added {min(i + playlist_batch_size, len(playlist_items))}/{len(playlist_items)} tracks to the playlist")
+    return playlist_id
+
+# Seeded shuffle, a keyed feistel network is a permutation of every number with the same number of bits
+# Numbers outside the playlist are passed through it again (cycle walking) until they land inside it
+# so the track at any position can be worked out on its own without shuffling the whole playlist
+shuffle_rounds = 6
+
+def shuffle_key(playlist_id, seed):
+    return hashlib.blake2b(f"{playlist_id}:{seed}".encode(), digest_size=16).digest()
+
+def shuffle_round(key, round_number, value, mask):
+    digest = hashlib.blake2b(round_number.to_bytes(1, "big") + value.to_bytes(8, "big"), digest_size=8, key=key).digest()
+    return int.from_bytes(digest, "big") & mask
+
+def shuffle_feistel(value, half_bits, key, inverse=False):
+    mask = (1 << half_bits) - 1
+    left = value >> half_bits
+    right = value & mask
+    if not inverse:
+        for round_number in range(shuffle_rounds):
+            left, right = right, left ^ shuffle_round(key, round_number, right, mask)
+    else:
+        for round_number in reversed(range(shuffle_rounds)):
+            left, right = right ^ shuffle_round(key, round_number, left, mask), left
+    return (left << half_bits) | right
+
+def shuffle_permute(value, size, key, inverse=False):
+    # Index in the playlist of the track at a position in the shuffle, or the position of an index with inverse
+    half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+    value = shuffle_feistel(value, half_bits, key, inverse)
+    while value >= size:
+        value = shuffle_feistel(value, half_bits, key, inverse)
+    return value
+
+def shuffle_state_path():
+    return os.path.join(cache_dir, "shuffle_positions.json")
+
+def shuffle_state_read():
+    try:
+        with open(shuffle_state_path()) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+def shuffle_state_write(state):
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = shuffle_state_path() + ".tmp"
+    with open(temp_path, "w") as state_file:
+        json.dump(state, state_file, indent=1)
+    os.replace(temp_path, shuffle_state_path())
+
+def shuffle_playlist_seeded(playlist_id, playlist_items):
+    # Add the next window of tracks in the seeded order to a new playlist and save where it stopped
+    size = len(playlist_items)
+    key = shuffle_key(playlist_id, shuffle_seed)
+    state = shuffle_state_read()
+    state_key = f"{playlist_id}:{shuffle_seed}"
+    position = state.get(state_key, {}).get("position", 0)
+    if state.get(state_key, {}).get("size", size) != size:
+        print("The playlist has changed since the last run, the order will be different")
+    if shuffle_position != None:
+        position = shuffle_position
+    if start != None:
+        position = shuffle_permute(playlist_items.index(start), size, key, inverse=True)
+    if position >= size:
+        print("Reached the end of the shuffled playlist, starting again from the beginning")
+        position = 0
+    end = size
+    if shuffle_window != None:
+        end = min(size, position + shuffle_window)
+    print(f"Adding positions {position} to {end - 1} of {size} in the shuffled order")
+    new_items = [playlist_items[shuffle_permute(index, size, key)] for index in range(position, end)]
+    save_playlist(new_playlist_name, new_items)
+    state[state_key] = {"position": end, "size": size}
+    shuffle_state_write(state)
     return
 
 def shuffle_playlist(playlist_id):
@@ -183,6 +1455,10 @@ def shuffle_playlist(playlist_id):
     playlist_items=[]
     for item in playlist["Items"]:
         playlist_items.append(item["Id"])
+
+    if shuffle_seed != None:
+        shuffle_playlist_seeded(playlist_id, playlist_items)
+        return
     
     if start != None:
         # Search for the start track id in the playlist and get the index number
@@ -199,16 +1475,14 @@ def shuffle_playlist(playlist_id):
 
 def jellyfin_auth_by_user(username, password):
     # Authenticate by user when elevated permissions are required
-    headers = {
-        "x-emby-authorization": f"MediaBrowser Client=\"{script_name}\", Device=\"{script_name}\", DeviceId=\"{script_name}\", Version=\"{script_version}\"",
-        "Content-Type": "application/json"
-    }
     data = {
         "Username": username,
         "Pw": password
     }
     url = f"{jellyfin_server}/Users/AuthenticateByName"
-    response = requests.post(url, headers=headers, json=data)
+    # The old token is left out, logging in again must not depend on it
+    headers = {name: value for name, value in jellyfin_headers["user"].items() if name != "x-mediabrowser-token"}
+    response = http_request("jellyfin", "POST", url, headers=headers, json_data=data)
     if response.status_code != 200:
         print(f"Error: {response.status_code} {response.reason}")
         sys.exit(1)
@@ -219,59 +1493,272 @@ def prompt_for_username_password():
     password = getpass.getpass('Password:')
     return jellyfin_auth_by_user(username, password)
 
-def get_albums(jellyfin_server):
-    # Get all the albums from the jellyfin server
-    # Requires authentication
-    headers = {
-        "x-emby-authorization": f"MediaBrowser Client=\"{script_name}\", Device=\"{script_name}\", DeviceId=\"{script_name}\", Version=\"{script_version}\"",
-    }
-    headers['x-mediabrowser-token'] = tokens[0]
-    url = f"{jellyfin_server}/Items?userId={tokens[1]}&SortBy=SortName&IncludeItemTypes=MusicAlbum&filters=IsFolder&Recursive=true&Fields=ProviderIds"
-    
-    response = requests.get(url, headers=headers)
+# Saved jellyfin login, later runs use the token again instead of logging in
+session_lock = threading.Lock()
+# Set when logging in again failed, the requests that need the login fail instead of asking again
+session_login_failed = False
+
+def session_path():
+    return os.path.join(cache_dir, "session.json")
+
+def session_read():
+    # Return the saved token and user id, or None if there is no saved login for this server
+    try:
+        with open(session_path()) as session_file:
+            session = json.load(session_file)
+    except (OSError, ValueError):
+        return None
+    if session.get("server") != jellyfin_server:
+        return None
+    return session["token"], session["user_id"]
+
+def session_write(session_tokens):
+    # The token gives the same access as the password so only the owner can read the file
+    os.makedirs(cache_dir, exist_ok=True)
+    path = session_path()
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(descriptor, 0o600)
+    with os.fdopen(descriptor, "w") as session_file:
+        json.dump({"server": jellyfin_server, "token": session_tokens[0], "user_id": session_tokens[1]}, session_file)
+    os.replace(temporary_path, path)
+
+def session_valid(session_tokens):
+    # Ask jellyfin who the token belongs to, this fails if the token has expired or was revoked
+    headers = dict(jellyfin_headers["user"], **{"x-mediabrowser-token": session_tokens[0]})
+    response = http_request("jellyfin", "GET", f"{jellyfin_server}/Users/Me", headers=headers)
+    return response.status_code == 200
+
+def session_login():
+    # Log in with JELLYFIN_USERNAME and JELLYFIN_PASSWORD, or ask for the username and password
+    stat_add("jellyfin logins")
+    if jellyfin_username != None and jellyfin_password != None:
+        return jellyfin_auth_by_user(jellyfin_username, jellyfin_password)
+    print("Enter username and password for jellyfin server")
+    try:
+        return prompt_for_username_password()
+    except EOFError:
+        print("Error: No username and password to log in to jellyfin with, set JELLYFIN_USERNAME and JELLYFIN_PASSWORD for runs nobody is watching")
+        sys.exit(1)
+
+def session_start(rejected_token=None):
+    # Use the saved login if jellyfin still accepts it, otherwise log in and save the new login
+    # Another process may have saved a new login after rejected_token expired
+    global tokens
+    saved = session_read() if use_session else None
+    if saved != None and saved[0] != rejected_token and session_valid(saved):
+        tokens = saved
+    else:
+        tokens = session_login()
+        if use_session:
+            session_write(tokens)
+    jellyfin_set_token(tokens[0])
+
+def session_refresh(rejected_token):
+    # Log in again after jellyfin rejected a token, the first thread to get here logs in and the others use its login
+    # Returns False if there is no new login to send the request with
+    global session_login_failed
+    with session_lock:
+        if tokens[0] != rejected_token:
+            return True
+        if session_login_failed:
+            return False
+        # Show the prompts even when the thread's output is being collected
+        buffer = getattr(sys.stdout.local, "buffer", None)
+        sys.stdout.local.buffer = None
+        try:
+            print("The jellyfin login has expired, logging in again")
+            session_start(rejected_token)
+        except SystemExit:
+            # The login failed and the error has been printed, this may be a worker thread so the run is not stopped here
+            session_login_failed = True
+            return False
+        finally:
+            sys.stdout.local.buffer = buffer
+        return True
+
+def jellyfin_get_page(url, start_index, page_size, auth="api", profile=None):
+    # Get one page of items from a jellyfin query
+    url = f"{url}&StartIndex={start_index}&Limit={page_size}"
+    response = jellyfin_get(url, auth=auth, profile=profile)
     if response.status_code != 200:
         print(f"URL: {url}")
         print(f"Error: {response.status_code} {response.reason}")
         sys.exit(1)
-    return response.json()["Items"]
+    return response.json()
 
-def get_album_musicbrains_ids(jellyfin_server, jellyfin_api_key, jellyfin_album_id):
-    # Get the album artist id from the jellyfin server
-    headers = {
-        "x-emby-token": jellyfin_api_key
-    }
-    url = f"{jellyfin_server}/Items?Ids={jellyfin_album_id}&Fields=ProviderIds"
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"Error: {response.status_code} {response.reason}")
+def jellyfin_get_pages(url, page_size, auth="api", profile=None):
+    # Yield each page of items from a jellyfin query
+    # The next page is downloaded in the background while the current page is processed
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        page = executor.submit(jellyfin_get_page, url, 0, page_size, auth, profile)
+        start_index = 0
+        while page != None:
+            items = page.result()
+            start_index += len(items["Items"])
+            page = None
+            if len(items["Items"]) > 0 and start_index < items["TotalRecordCount"]:
+                page = executor.submit(jellyfin_get_page, url, start_index, page_size, auth, profile)
+            yield items["Items"]
+
+def get_albums(jellyfin_server, min_date_last_saved=None, sort_by="SortName"):
+    # Get all the albums from the jellyfin server, one page at a time
+    # The id breaks ties between albums with the same sort name, otherwise they could move between pages and be skipped or processed twice
+    # Requires authentication
+    url = f"{jellyfin_server}/Items?userId={tokens[1]}&SortBy={sort_by},Id&IncludeItemTypes=MusicAlbum&filters=IsFolder&Recursive=true{jellyfin_fields(album_profile())}"
+    if min_date_last_saved != None:
+        # New albums are saved when they are added so this also finds albums added since the date
+        url += f"&MinDateLastSaved={min_date_last_saved}"
+    for albums in jellyfin_get_pages(url, album_page_size, auth="user", profile=album_profile()):
+        albums = [Album(album) for album in albums]
+        album_store_add(albums)
+        for album in albums:
+            yield album
+
+# Compact records for the albums and tracks kept in memory, only the fields the script uses are kept
+# They are read like the jellyfin json, eg: track["Name"], "IndexNumber" in track, track.get("RunTimeTicks")
+class Record:
+    __slots__ = ()
+
+    def __init__(self, item):
+        for key in self.__slots__:
+            setattr(self, key, item.get(key))
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        if value is None:
+            return default
+        return value
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__ if getattr(self, key) is not None}
+
+# The same lists of names are shared by every track with them
+record_name_lists = {}
+
+def record_names(values):
+    # Names shared by many tracks are interned so each one is only stored once
+    if not values:
+        return ()
+    names = tuple(sys.intern(value["Name"] if type(value) == dict else value) for value in values)
+    return record_name_lists.setdefault(names, names)
+
+class Track(Record):
+    # Artists and studios only keep their names, the path is taken from the first media source if it is not set
+    __slots__ = ("Id", "Name", "Type", "IndexNumber", "ParentIndexNumber", "Path", "RunTimeTicks", "Album", "AlbumId", "ParentId",
+                 "PremiereDate", "ProductionYear", "ProviderIds", "Artists", "AlbumArtists", "ArtistItems", "Genres", "Tags", "Studios")
+
+    def __init__(self, item):
+        Record.__init__(self, item)
+        for key in ("Type", "Album", "AlbumId", "ParentId", "PremiereDate"):
+            if self.get(key) != None:
+                setattr(self, key, sys.intern(getattr(self, key)))
+        for key in ("Artists", "AlbumArtists", "ArtistItems", "Genres", "Tags", "Studios"):
+            if getattr(self, key) != None:
+                setattr(self, key, record_names(getattr(self, key)))
+        if self.ProviderIds != None:
+            self.ProviderIds = {sys.intern(key): value for key, value in self.ProviderIds.items()}
+        if self.Path == None and item.get("MediaSources"):
+            self.Path = item["MediaSources"][0].get("Path")
+
+class Album(Record):
+    # Everything jellyfin reads when an album is updated, the album is sent back with to_dict
+    __slots__ = ("Id", "Name", "Type", "ParentId", "OriginalTitle", "ForcedSortName", "IndexNumber", "ParentIndexNumber", "PremiereDate",
+                 "ProductionYear", "DateCreated", "EndDate", "CommunityRating", "CriticRating", "OfficialRating", "LockData", "LockedFields",
+                 "AlbumArtist", "AlbumArtists", "ArtistItems", "Artists", "Genres", "Tags", "Studios", "ProviderIds")
+
+def tracks_from_json(items):
+    return [item if isinstance(item, Record) else Track(item) for item in items]
+
+def flatten_items(items, key="Name", item_type="Audio"):
+    # Flatten nested lists and tuples of items into a single list of items of one type, without recursion
+    items_list = []
+    stack = [iter([items])]
+    while stack:
+        for item in stack[-1]:
+            if type(item) == list or type(item) == tuple:
+                stack.append(iter(item))
+                break
+            if (type(item) == dict or isinstance(item, Record)) and key in item and item["Type"] == item_type:
+                items_list.append(item)
+        else:
+            stack.pop()
+    return items_list
+
+def album_profile():
+    # Albums only need their musicbrainz ids unless their genres are being updated
+    if update_genre:
+        return "genre"
+    return "album-ids"
+
+# Album metadata for this run, filled from the album listing so each album only has to be read once
+album_store = {}
+album_store_lock = threading.Lock()
+
+def album_store_add(albums):
+    with album_store_lock:
+        for album in albums:
+            if not isinstance(album, Album):
+                album = Album(album)
+            album_store[album["Id"]] = album
+
+def album_store_get(jellyfin_album_id):
+    # Return the album metadata, reading it from the jellyfin server if it is not in the store
+    # Albums processed by all are always in the store from the album listing, only a single album has to be read
+    if jellyfin_album_id not in album_store:
+        url = f"{jellyfin_server}/Items?Ids={jellyfin_album_id}{jellyfin_fields(album_profile())}"
+        response = jellyfin_get(url, profile=album_profile())
+        if response.status_code != 200:
+            print(f"URL: {url}")
+            print(f"Error: {response.status_code} {response.reason}")
+            sys.exit(1)
+        album_store_add(response.json()["Items"])
+    if jellyfin_album_id not in album_store:
+        print(f"Error: Album not found: {jellyfin_album_id}")
         sys.exit(1)
+    return album_store[jellyfin_album_id]
+
+def get_album_musicbrains_ids(jellyfin_server, jellyfin_api_key, jellyfin_album_id):
+    # Get the album artist id from the album store
+    album = album_store_get(jellyfin_album_id)
     # Check if the album has a musicbrainz album id
-    if "MusicBrainzAlbum" in response.json()["Items"][0]["ProviderIds"] and "MusicBrainzReleaseGroup" in response.json()["Items"][0]["ProviderIds"]:
-        musicbrainz_album_id = response.json()["Items"][0]["ProviderIds"]["MusicBrainzAlbum"]
-        release_id = response.json()["Items"][0]["ProviderIds"]["MusicBrainzReleaseGroup"]
-        return musicbrainz_album_id, release_id, response.json()["Items"][0]["Name"]
+    if "MusicBrainzAlbum" in album["ProviderIds"] and "MusicBrainzReleaseGroup" in album["ProviderIds"]:
+        musicbrainz_album_id = album["ProviderIds"]["MusicBrainzAlbum"]
+        release_id = album["ProviderIds"]["MusicBrainzReleaseGroup"]
+        return musicbrainz_album_id, release_id, album["Name"]
     else:
-        return False, response.json()["Items"][0]["Name"]
+        return False, album["Name"]
 
 def jellyfin_album_genre_tagger(jellyfin_album_id, genres):
     # Get current metadata
     album = jellyfin_get_album(jellyfin_server, jellyfin_api_key, jellyfin_album_id)
     # Requires authentication
-    headers = {
-        "x-emby-authorization": f"MediaBrowser Client=\"{script_name}\", Device=\"{script_name}\", DeviceId=\"{script_name}\", Version=\"{script_version}\"",
-        "Content-Type": "application/json"
-    }
-    headers['x-mediabrowser-token'] = tokens[0]
     # Use all of the current metadata and update the genres
-    data = album["Items"][0]
+    data = album["Items"][0].to_dict()
     data["Genres"] = genres
+    if set(album["Items"][0].get("Genres", [])) == set(genres):
+        print(f"Genres already set for album: {data['Name']}, skipping")
+        stat_add("jellyfin writes suppressed")
+        return
     print(f"Data: {json.dumps(data)}")
     url = f"{jellyfin_server}/Items/{jellyfin_album_id}"
-    response = requests.post(url, headers=headers, json=data)
-    if response.status_code != 204:
-        print(f"URL: {url}")
-        print(f"Error: {response.status_code} {response.reason}")
-        sys.exit(1)
+    jellyfin_write(url, data)
+    album_store_add([data])
     print(f"Updated genres for album: {album['Items'][0]['Name']}")
 
     return
@@ -280,101 +1767,68 @@ def jellyfin_artist_genre_tagger(jellyfin_artist_id, genres):
     # Placeholder - A function to add genres to an artist
     return
 
-def jellyfin_genre_update(jellyfin_album_id):
+def jellyfin_genre_update(jellyfin_album_id, album_ids=None):
+    # album_ids is the result of get_album_musicbrains_ids if the caller already has it
+    if album_ids == None:
+        album_ids = get_album_musicbrains_ids(jellyfin_server, jellyfin_api_key, jellyfin_album_id)
     # Get release id
-    release_id = get_album_musicbrains_ids(jellyfin_server, jellyfin_api_key, jellyfin_album_id)[1]
+    release_id = album_ids[1]
     # Get album name
-    album_name = get_album_musicbrains_ids(jellyfin_server, jellyfin_api_key, jellyfin_album_id)[2]
-    musicbrainz_genres = musicbrainz_get_release_genre(musicbrainz_server, release_id)
-    musicbrainz_artist = musicbrainz_artist_id(musicbrainz_server, release_id)
-    # Skip artist genre for multi artist albums
-    if not musicbrainz_multi_artist_album(musicbrainz_server, release_id):
-        musicbrainz_artist_genres = musicbrainz_get_artist_genre(musicbrainz_server, musicbrainz_artist)
-        musicbrainz_genres += musicbrainz_artist_genres
-    else:
-        print("Multi artist album, skipping artist genres")
+    album_name = album_ids[2]
+    with phase_timer("fetch"):
+        musicbrainz_genres = musicbrainz_get_release_genre(musicbrainz_server, release_id)
+        musicbrainz_artist = musicbrainz_artist_id(musicbrainz_server, release_id)
+        # Skip artist genre for multi artist albums
+        if not musicbrainz_multi_artist_album(musicbrainz_server, release_id):
+            musicbrainz_genres += musicbrainz_get_artist_genre(musicbrainz_server, musicbrainz_artist)
+        else:
+            print("Multi artist album, skipping artist genres")
     # remove duplicates
     musicbrainz_genres = list(dict.fromkeys(musicbrainz_genres))
     # Skip if there are no genres
     if len(musicbrainz_genres) == 0:
         print("No genres found, skipping")
-        return False, album_name
+        return False, album_name, "GENRESKIPPED"
     # Get musicbrainz artist id
     print (f"Musicbrainz genres: {musicbrainz_genres}")
     # Update album genres
-    jellyfin_album_genre_tagger(jellyfin_album_id, musicbrainz_genres)
-    return True, album_name
+    with phase_timer("write"):
+        jellyfin_album_genre_tagger(jellyfin_album_id, musicbrainz_genres)
+    return True, album_name, "GENREUPDATED"
 
 def musicbrainz_multi_artist_album(musicbrainz_server, musicbrainz_album_id):
     # Get the musicbrainz album id from the musicbrainz server
-    headers = {
-        "Accept": "application/json",
-        "User-Agent": f"{script_name}/{script_version} ( {script_contact} )"
-    }
-    url = f"{musicbrainz_server}/release-group/{musicbrainz_album_id}?inc=artists"
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"URL: {url}")
-        print(f"Error: {response.status_code} {response.reason}")
-        sys.exit(1)
-    if len(response.json()["artist-credit"]) > 1:
+    release_group = musicbrainz_lookup("release-group", musicbrainz_album_id, ["artists"])
+    if len(release_group["artist-credit"]) > 1:
         return True
-    if response.json()["artist-credit"][0]["artist"]["name"] == "Various Artists":
+    if release_group["artist-credit"][0]["artist"]["name"] == "Various Artists":
         return True
     else:
         return False
 
 def musicbrainz_artist_id(musicbrainz_server, album_id):
     # Get the musicbrainz artist id from the musicbrainz server
-    headers = {
-        "Accept": "application/json",
-        "User-Agent": f"{script_name}/{script_version} ( {script_contact} )"
-    }
-    url = f"{musicbrainz_server}/release-group/{album_id}?inc=artists"
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"URL: {url}")
-        print(f"Error: {response.status_code} {response.reason}")
-        sys.exit(1)
-    return response.json()["artist-credit"][0]["artist"]["id"]
+    release_group = musicbrainz_lookup("release-group", album_id, ["artists"])
+    return release_group["artist-credit"][0]["artist"]["id"]
 
 def jellyfin_get_artist(jellyfin_server, jellyfin_api_key, jellyfin_artist_id):
     # Get the artist from the jellyfin server
-    headers = {
-        "x-emby-token": jellyfin_api_key
-    }
     url = f"{jellyfin_server}/Items?Ids={jellyfin_artist_id}"
-    response = requests.get(url, headers=headers)
+    response = jellyfin_get(url)
     if response.status_code != 200:
         print(f"Error: {response.status_code} {response.reason}")
         sys.exit(1)
     return response.json()
 
 def jellyfin_get_album(jellyfin_server, jellyfin_api_key, jellyfin_album_id):
-    # Get the album from the jellyfin server
-    headers = {
-        "x-emby-token": jellyfin_api_key
-    }
-    url = f"{jellyfin_server}/Items?Ids={jellyfin_album_id}&fields=ProviderIds,Genres,Tags,Studios,ParentId,MediaSources"
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"Error: {response.status_code} {response.reason}")
-        sys.exit(1)
-    return response.json()
+    # Get the album from the album store, in the same shape as the jellyfin Items response
+    return {"Items": [album_store_get(jellyfin_album_id)], "TotalRecordCount": 1}
 
 def musicbrainz_get_artist_genre(musicbrainz_server, musicbrainz_artist_id):
     # Get the artist genres from the musicbrainz server
-    headers = {
-        "Accept": "application/json",
-        "User-Agent": f"{script_name}/{script_version} ( {script_contact} )"
-    }
-    url = f"{musicbrainz_server}/artist/{musicbrainz_artist_id}?inc=genres"
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"Error: {response.status_code} {response.reason}")
-        sys.exit(1)
+    artist = musicbrainz_lookup("artist", musicbrainz_artist_id, ["genres"])
     genres = []
-    for genre in response.json()["genres"]:
+    for genre in artist["genres"]:
         # Add only if count is greater than 1
         if genre["count"] > int(count):
             genres.append(genre["name"])
@@ -382,18 +1836,9 @@ def musicbrainz_get_artist_genre(musicbrainz_server, musicbrainz_artist_id):
 
 def musicbrainz_get_release_genre(musicbrainz_server, musicbrainz_release_id):
     # Get the release genres from the musicbrainz server
-    headers = {
-        "Accept": "application/json",
-        "User-Agent": f"{script_name}/{script_version} ( {script_contact} )"
-    }
-    url = f"{musicbrainz_server}/release-group/{musicbrainz_release_id}?inc=genres"
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"Error: {response.status_code} {response.reason}")
-        print(f"URL: {url}")
-        sys.exit(1)
+    release_group = musicbrainz_lookup("release-group", musicbrainz_release_id, ["genres"])
     genres = []
-    for genre in response.json()["genres"]:
+    for genre in release_group["genres"]:
         # Add only if count is greater than 1
         if genre["count"] > int(count):
             genres.append(genre["name"])
@@ -401,47 +1846,85 @@ def musicbrainz_get_release_genre(musicbrainz_server, musicbrainz_release_id):
 
 def get_album_tracks(jellyfin_server, jellyfin_api_key, jellyfin_album_id):
     # Get all the tracks from the jellyfin server for the album
-    headers = {
-        "x-emby-token": jellyfin_api_key
-    }
-    url = f"{jellyfin_server}/Items?ParentId={jellyfin_album_id}{jellyfin_meta}"
-    response = requests.get(url, headers=headers)
+    url = f"{jellyfin_server}/Items?ParentId={jellyfin_album_id}{jellyfin_meta}{jellyfin_fields('trackid')}"
+    response = jellyfin_get(url, profile="trackid")
     if response.status_code != 200:
         print(f"URL: {url}")
         print(f"Error: {response.status_code} {response.reason}")
         sys.exit(1)
     if response.json()["TotalRecordCount"] == 0:
         print(f"Error: No tracks found for album id: {jellyfin_album_id}, it is problably a multi disc album")
-        url = f"{jellyfin_server}/Items?ParentId={jellyfin_album_id}&fields=ParentId,MediaSources&includeItemTypes=Folder&SortBy=SortName"
-        discs = requests.get(url, headers=headers)
+        url = f"{jellyfin_server}/Items?ParentId={jellyfin_album_id}{jellyfin_fields('verify')}&includeItemTypes=Folder&SortBy=SortName"
+        discs = jellyfin_get(url, profile="verify")
         if discs.status_code != 200:
             print(f"URL: {url}")
             print(f"Error: {discs.status_code} {discs.reason}")
             sys.exit(1)
         tracks = []
         for disc in discs.json()["Items"]:
-            url = f"{jellyfin_server}/Items?ParentId={disc['Id']}{jellyfin_meta}"
-            response = requests.get(url, headers=headers)
+            url = f"{jellyfin_server}/Items?ParentId={disc['Id']}{jellyfin_meta}{jellyfin_fields('trackid')}"
+            response = jellyfin_get(url, profile="trackid")
             if response.status_code != 200:
                 print(f"URL: {url}")
                 print(f"Error: {response.status_code} {response.reason}")
                 sys.exit(1)
-            tracks += response.json()["Items"], True
+            tracks += tracks_from_json(response.json()["Items"])
     else:
-        tracks = response.json()["Items"]
-    return tracks, False
+        tracks = tracks_from_json(response.json()["Items"])
+    return tracks
+
+# Tracks for each album id, filled by build_track_index and emptied as the albums are processed
+track_index = {}
+
+def track_index_sort_key(track):
+    # Order tracks by disc then track number, tracks in disc folders are grouped by their folder
+    disc_folder = ""
+    if track.get("ParentId") != track.get("AlbumId") and track.get("Path") != None:
+        disc_folder = os.path.dirname(track["Path"])
+    return track.get("ParentIndexNumber") or 0, disc_folder, track.get("IndexNumber") or 0
+
+def build_track_index(jellyfin_server, jellyfin_album_ids):
+    # Read the tracks of a batch of albums with paged requests and group them by album
+    # The id breaks ties between tracks with the same sort name so a track cannot move between pages
+    index = {}
+    url = f"{jellyfin_server}/Items?AlbumIds={','.join(jellyfin_album_ids)}&IncludeItemTypes=Audio&Recursive=true&SortBy=SortName,Id&mediaTypes=Audio{jellyfin_fields('trackid')}"
+    for tracks in jellyfin_get_pages(url, track_page_size, profile="trackid"):
+        for track in tracks_from_json(tracks):
+            index.setdefault(track.get("AlbumId"), []).append(track)
+    for tracks in index.values():
+        tracks.sort(key=track_index_sort_key)
+    stat_add("tracks in track index", sum(len(tracks) for tracks in index.values()))
+    track_index.update(index)
+
+def track_index_albums(albums):
+    # Pass the albums through, reading the tracks of the next track_index_batch_size albums before they are processed
+    # Only the albums this run processes are read, so --resume, --since and --shard do not read the whole library
+    batch = []
+    for album in albums:
+        batch.append(album)
+        if len(batch) >= track_index_batch_size:
+            build_track_index(jellyfin_server, [album["Id"] for album in batch])
+            yield from batch
+            batch = []
+    if len(batch) > 0:
+        build_track_index(jellyfin_server, [album["Id"] for album in batch])
+        yield from batch
+
+def album_tracks_lookup(jellyfin_album_id):
+    # Get the tracks for an album from the track index, or from the jellyfin server if it is not indexed
+    tracks = track_index.pop(jellyfin_album_id, None)
+    if tracks != None:
+        return tracks
+    return get_album_tracks(jellyfin_server, jellyfin_api_key, jellyfin_album_id)
 
 def get_single_track_info(jellyfin_server, jellyfin_api_key, jellyfin_track_id):
     # Get all the tracks from the jellyfin server for the album
-    headers = {
-        "x-emby-token": jellyfin_api_key
-    }
     url = f"{jellyfin_server}/Items?Ids={jellyfin_track_id}"
-    response = requests.get(url, headers=headers)
+    response = jellyfin_get(url)
     if response.json()["TotalRecordCount"] == 0:
         print(f"Error: No tracks found for album id: {jellyfin_album_id}")
         url = f"{jellyfin_server}/Items?ParentId={jellyfin_album_id}"
-        response = requests.get(url, headers=headers)
+        response = jellyfin_get(url)
     if response.status_code != 200:
         print(f"URL: {url}")
         print(f"Error: {response.status_code} {response.reason}")
@@ -451,26 +1934,11 @@ def get_single_track_info(jellyfin_server, jellyfin_api_key, jellyfin_track_id):
 
 def get_musicbrainz_track_ids(musicbrainz_server, musicbrainz_album_id):
     # Get the musicbrainz track ids from the musicbrainz server
-    headers = {
-        "Accept": "application/json",
-        "User-Agent": f"{script_name}/{script_version} ( {script_contact} )"
-    }
-    url = f"{musicbrainz_server}/release/{musicbrainz_album_id}?inc=recordings"
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"URL: {url}")
-        print(f"Error: {response.status_code} {response.reason}")
-        sys.exit(1)
-    return response.json()
+    return musicbrainz_lookup("release", musicbrainz_album_id, ["recordings"])
 
 def jellyfin_set_folder_parent(jellyfin_server, jellyfin_album_id, folder_id):
     # Set the parent id for the folder to the album id
     # Requires authentication
-    headers = {
-        "x-emby-authorization": f"MediaBrowser Client=\"{script_name}\", Device=\"{script_name}\", DeviceId=\"{script_name}\", Version=\"{script_version}\"",
-        "Content-Type": "application/json"
-    }
-    headers['x-mediabrowser-token'] = tokens[0]
     data = {
         "ParentId": jellyfin_album_id,
         "LockData": True
@@ -480,22 +1948,41 @@ def jellyfin_set_folder_parent(jellyfin_server, jellyfin_album_id, folder_id):
 
     response = "Null"
     if not dry_run:
-        response = requests.post(url, headers=headers, json=data)
-        if response.status_code != 204:
-            print(f"URL: {url}")
-            print(f"Error: {response.status_code} {response.reason}")
-            sys.exit(1)
+        response = jellyfin_write(url, data)
 
     return response
 
+def comparable_value(value, single_disc=False):
+    # Jellyfin and musicbrainz use different types for the same value, eg: 1 and "1", None and "", a name and {"Name": name}
+    # Disc 1 of a single disc album is the same as no disc number
+    if type(value) == dict and list(value) == ["Name"]:
+        value = value["Name"]
+    if type(value) in (list, tuple):
+        value = [comparable_value(item) for item in value]
+    if type(value) == dict:
+        # Jellyfin does not keep provider ids set to ""
+        value = {key: item for key, item in value.items() if item not in ("", None)}
+    if type(value) == str and value.isdigit():
+        value = int(value)
+    if single_disc and value == 1:
+        return None
+    if value in ("", [], {}):
+        return None
+    return value
+
+def item_unchanged(current, wanted, single_disc=False):
+    # Check if writing the wanted values would change anything
+    for key in wanted:
+        disc = single_disc and key == "ParentIndexNumber"
+        if comparable_value(current.get(key), disc) != comparable_value(wanted[key], disc):
+            return False
+    return True
+
 def jellyfin_get_album_folders(jellyfin_server, jellyfin_api_key, jellyfin_album_id):
     # Get all the folders from the jellyfin server for the album
-    headers = {
-        "x-emby-token": jellyfin_api_key
-    }
-    url = f"{jellyfin_server}/Items?Ids={jellyfin_album_id}&fields=ParentId,MediaSources&includeItemTypes=Folder&SortBy=SortName"
+    url = f"{jellyfin_server}/Items?Ids={jellyfin_album_id}{jellyfin_fields('verify')}&includeItemTypes=Folder&SortBy=SortName"
     print(f"URL: {url}")
-    response = requests.get(url, headers=headers)
+    response = jellyfin_get(url, profile="verify")
     if response.status_code != 200:
         print(f"Error: {response.status_code} {response.reason}")
         sys.exit(1)
@@ -507,14 +1994,14 @@ def jellyfin_get_album_folders(jellyfin_server, jellyfin_api_key, jellyfin_album
     return folder_ids
 
 
-def jellyfin_musicbrain_trackid_update(jellyfin_server, track_data, musicbrainz_track, musicbrainz_track_data, parent_data=None):
+def jellyfin_musicbrain_trackid_update(jellyfin_server, track_data, musicbrainz_track, musicbrainz_track_data, parent_data=None, disc_index=0):
     # Update the jellyfin server with the musicbrainz track id
     # Requires authentication
-    headers = {
-        "x-emby-authorization": f"MediaBrowser Client=\"{script_name}\", Device=\"{script_name}\", DeviceId=\"{script_name}\", Version=\"{script_version}\"",
-        "Content-Type": "application/json"
-    }
-    headers['x-mediabrowser-token'] = tokens[0]
+
+    # Keep the current values so unchanged tracks are not written again
+    current = {key: track_data.get(key) for key in ("Name", "IndexNumber", "ParentIndexNumber", "Album", "AlbumArtists", "ArtistItems", "Genres",
+                                                      "Tags", "Studios", "PremiereDate", "ProductionYear")}
+    current["ProviderIds"] = dict(track_data.get("ProviderIds", {}))
 
     # If the track numbers don't match then skip
     '''
@@ -525,18 +2012,15 @@ def jellyfin_musicbrain_trackid_update(jellyfin_server, track_data, musicbrainz_
     # Check musicbrainz_track_ids to see if there are multiple discs
     if len(musicbrainz_track_data) > 1:
         print(f"Multiple discs found")
-        for disc in musicbrainz_track_data:
-            if disc["format"] == "DVD-Video":
-                if "ParentIndexNumber" not in track_data:
-                    track_data["ParentIndexNumber"] = ""
-                break
-            for track in disc["tracks"]:
-                if track == musicbrainz_track:
-                    print(f"Disc: {disc['position']}")
-                    print(f"Track: {track['number']}")
-                    track_data["IndexNumber"] = track["number"]
-                    track_data["ParentIndexNumber"] = disc["position"]
-                    break
+        if any(disc["format"] == "DVD-Video" for disc in musicbrainz_track_data[:disc_index + 1]):
+            if "ParentIndexNumber" not in track_data:
+                track_data["ParentIndexNumber"] = ""
+        else:
+            disc = musicbrainz_track_data[disc_index]
+            print(f"Disc: {disc['position']}")
+            print(f"Track: {musicbrainz_track['number']}")
+            track_data["IndexNumber"] = musicbrainz_track["number"]
+            track_data["ParentIndexNumber"] = disc["position"]
     else:
         track_data["ParentIndexNumber"] = ""
     # Check if the track has the required keys
@@ -557,11 +2041,11 @@ def jellyfin_musicbrain_trackid_update(jellyfin_server, track_data, musicbrainz_
         "IndexNumber": track_data["IndexNumber"],
         "Album": track_data["Album"],
         # Only add the Name Keys for all the AlbumArtists
-        "AlbumArtists": [ { "Name": artist["Name"] } for artist in track_data["AlbumArtists"] ],
-        "ArtistItems": [ { "Name": artist["Name"] } for artist in track_data["ArtistItems"] ],
-        "Genres": track_data["Genres"],
+        "AlbumArtists": [ { "Name": artist } for artist in track_data["AlbumArtists"] ],
+        "ArtistItems": [ { "Name": artist } for artist in track_data["ArtistItems"] ],
+        "Genres": list(track_data["Genres"]),
         "Tags": [],
-        "Studios": [ { "Name": studio["Name"] } for studio in track_data["Studios"] ],
+        "Studios": [ { "Name": studio } for studio in track_data["Studios"] ],
         "PremiereDate": track_data["PremiereDate"],
         "ProductionYear": track_data["ProductionYear"],
         "ParentIndexNumber": track_data["ParentIndexNumber"],
@@ -588,14 +2072,15 @@ def jellyfin_musicbrain_trackid_update(jellyfin_server, track_data, musicbrainz_
 
     print(f"Data: {json.dumps(data)}")
     url = f"{jellyfin_server}/Items/{track_data['Id']}"
+    # Every field the update sends is compared, eg: the update also clears the tags and the other provider ids
+    if merge == None and item_unchanged(current, {key: value for key, value in data.items() if key != "Id"}, len(musicbrainz_track_data) == 1):
+        print(f"No changes for track: {track_data['Name']}, skipping")
+        stat_add("jellyfin writes suppressed")
+        return "Null"
 
     response = "Null"
     if not dry_run:
-        response = requests.post(url, headers=headers, json=data)
-        if response.status_code != 204:
-            print(f"URL: {url}")
-            print(f"Error: {response.status_code} {response.reason}")
-            sys.exit(1)
+        response = jellyfin_write(url, data)
     else:
         print(f"Data: {data}")
 
@@ -603,31 +2088,129 @@ def jellyfin_musicbrain_trackid_update(jellyfin_server, track_data, musicbrainz_
 
 def get_multi_disc_children(jellyfin_server, jellyfin_api_key, jellyfin_album_id):
     # Get all the tracks from the jellyfin server for the album
-    headers = {
-        "x-emby-token": jellyfin_api_key
-    }
-    url = f"{jellyfin_server}/Items?ParentId={jellyfin_album_id}&fields=ParentId,MediaSources&includeItemTypes=Folder&SortBy=SortName"
+    url = f"{jellyfin_server}/Items?ParentId={jellyfin_album_id}{jellyfin_fields('verify')}&includeItemTypes=Folder&SortBy=SortName"
     print(f"URL: {url}")
-    response = requests.get(url, headers=headers)
+    response = jellyfin_get(url, profile="verify")
     if response.status_code != 200:
         print(f"Error: {response.status_code} {response.reason}")
         sys.exit(1)
     return response.json()["Items"]
 
-def jellyfin_album_musicbrainz_trackid_update(jellyfin_server, album_tracks, musicbrainz_track_data):
-    # Get all the tracks from the jellyfin server for the album
-    #print(json.dumps(musicbrainz_track_data, indent=4))
-    m_indx = 0
-    # jf_indx is used to split the tracks into discs
-    jf_indx = 0
-    AlbumPrimaryImageTag = None
-    ImageBlurHashes = None
-
-    for item in album_tracks:
-        if item["Type"] != "Audio":
+# Track matching, each jellyfin track is compared with a few musicbrainz tracks found through these indexes
+# instead of pairing them by position, so a missing or extra track does not move every track after it
+# Score for the same title, the same length within match_length_seconds and the same disc and track number
+match_title_score = 0.5
+match_length_score = 0.3
+match_position_score = 0.2
+match_length_seconds = 3
+
+def match_title(title):
+    # Lower case letters and numbers only, so punctuation and accents do not stop titles matching
+    if not title:
+        return ""
+    title = unicodedata.normalize("NFKD", title)
+    return "".join(character for character in title.casefold() if character.isalnum())
+
+def match_position(item):
+    # Disc and track number of a jellyfin track, numbers like 1-02 include the disc
+    number = item.get("IndexNumber")
+    if number == None:
+        return None
+    disc = item.get("ParentIndexNumber") or 1
+    if type(number) != int and "-" in str(number):
+        disc, number = str(number).split("-")[:2]
+    try:
+        return int(disc), int(number)
+    except ValueError:
+        return None
+
+def match_index(musicbrainz_media):
+    # Index the musicbrainz tracks by disc and track number, title and length
+    tracks = []
+    by_position = {}
+    by_title = collections.defaultdict(list)
+    by_length = collections.defaultdict(list)
+    for disc_index, disc in enumerate(musicbrainz_media):
+        for track in disc.get("tracks", []):
+            track_number = len(tracks)
+            tracks.append((track, disc_index))
+            by_position[(int(disc.get("position", disc_index + 1)), int(track["position"]))] = track_number
+            title = match_title(track.get("title") or track["recording"].get("title"))
+            by_title[title].append(track_number)
+            length = track.get("length") or track["recording"].get("length")
+            if length:
+                by_length[int(length / 1000 // match_length_seconds)].append(track_number)
+    return tracks, by_position, by_title, by_length
+
+def match_score(item, track, position, title):
+    score = 0
+    track_title = match_title(track.get("title") or track["recording"].get("title"))
+    if title and title == track_title:
+        score += match_title_score
+    elif title and track_title and (title in track_title or track_title in title):
+        score += match_title_score / 2
+    length = track.get("length") or track["recording"].get("length")
+    if item.get("RunTimeTicks") and length:
+        difference = abs(item["RunTimeTicks"] / 10000000 - length / 1000)
+        if difference <= match_length_seconds:
+            score += match_length_score
+        elif difference <= match_length_seconds * 3:
+            score += match_length_score / 2
+    elif position:
+        # Without a length to compare the track number counts for more
+        score += match_length_score / 2
+    if position:
+        score += match_position_score
+    return score
+
+def match_album_tracks(album_tracks, musicbrainz_media):
+    # Pair each jellyfin audio track with a musicbrainz track
+    # Returns a list of (jellyfin track, musicbrainz track or None, disc index, confidence between 0 and 1)
+    tracks, by_position, by_title, by_length = match_index(musicbrainz_media)
+    used = set()
+    matches = []
+    audio_tracks = [item for item in album_tracks if item["Type"] == "Audio"]
+    for sequence, item in enumerate(audio_tracks):
+        position = match_position(item)
+        title = match_title(item.get("Name"))
+        candidates = set(by_title.get(title, []))
+        # The track in the same place, this is how tracks were matched before
+        if sequence < len(tracks):
+            candidates.add(sequence)
+        position_match = None
+        if position != None:
+            position_match = by_position.get(position)
+            if position_match == None and position[1] > 100:
+                # Track numbers like 101 and 201 on albums with every disc in one folder
+                position_match = by_position.get((position[1] // 100, position[1] % 100))
+            if position_match != None:
+                candidates.add(position_match)
+        if item.get("RunTimeTicks"):
+            bucket = int(item["RunTimeTicks"] / 10000000 // match_length_seconds)
+            for near in (bucket - 1, bucket, bucket + 1):
+                candidates.update(by_length.get(near, []))
+        best = None
+        for candidate in candidates - used:
+            score = match_score(item, tracks[candidate][0], candidate == position_match, title)
+            rank = (score, candidate == sequence, -candidate)
+            if best == None or rank > best[0]:
+                best = (rank, candidate)
+        if best == None:
+            matches.append((item, None, 0, 0))
             continue
-        jf_indx += 1
-        print(f"Loop Index: {str(jf_indx)}")
+        score, candidate = best[0][0], best[1]
+        used.add(candidate)
+        matches.append((item, tracks[candidate][0], tracks[candidate][1], round(score, 2)))
+    return matches
+
+def match_low_confidence(matches):
+    return [match for match in matches if match[1] == None or match[3] < min_confidence]
+
+def jellyfin_album_musicbrainz_trackid_update(jellyfin_server, matches, musicbrainz_track_data):
+    # Update each jellyfin track with the musicbrainz track it was matched to
+    first_track = None
+
+    for item, musicbrainz_track, disc_index, confidence in matches:
         print(f"Track: {item['Name']}")
         print(f"Track id: {item['Id']}")
         print(f"Track Artists:")
@@ -639,39 +2222,30 @@ def jellyfin_album_musicbrainz_trackid_update(jellyfin_server, album_tracks, mus
             print(f"Track number: {str(item['IndexNumber'])}")
         else:
             print("Track number: None")
-        # If MusicBrainzTrack is already set then skip
-        disc_track_count = int(musicbrainz_track_data[m_indx]["track-count"])
-
+        # If a different MusicBrainzTrack is already set then skip
+        # A track already set to the matched id goes on so a wrong track or disc number is fixed, it is not written if nothing changed
         if "MusicBrainzTrack" in item["ProviderIds"]:
             print(f"MusicBrainzTrack: {item['ProviderIds']['MusicBrainzTrack']}")
-            print("MusicBrainzTrack already set, skipping")
-            if int(jf_indx) >= int(musicbrainz_track_data[m_indx]['track-count']):
-                m_indx += 1
-                jf_indx = 0
+            if merge != None or musicbrainz_track == None or item["ProviderIds"]["MusicBrainzTrack"] != musicbrainz_track["id"]:
+                print("MusicBrainzTrack already set, skipping")
+                continue
+        if musicbrainz_track == None:
+            print("No matching musicbrainz track found, skipping")
+            stat_add("low confidence track matches")
             continue
-        # Check if current index exists and return if not, to prevent out of range error      
-        if m_indx >= len(musicbrainz_track_data):
-            print("Musicbrainz track data index out of range, skipping")
-            return
-        '''
-        if m_indx == 0:
-            AlbumPrimaryImageTag = item['AlbumPrimaryImageTag']
-            ImageBlurHashes = item['ImageBlurHashes']
-            item['AlbumPrimaryImageTag'] = AlbumPrimaryImageTag
-            item['ImageBlurHashes'] = ImageBlurHashes
-        '''
-        if not musicbrainz_track_data[m_indx]['tracks'][jf_indx-1]['recording']['video']:
-            #print(json.dumps(musicbrainz_track_data[m_indx]['tracks'][item["IndexNumber"]-1]))
+        print(f"Matched: {musicbrainz_track['title']}, confidence: {confidence}")
+        if confidence < min_confidence:
+            print("Low confidence match, skipping")
+            stat_add("low confidence track matches")
+            continue
+        stat_add("track matches")
+        if not musicbrainz_track['recording']['video']:
             if merge == None:
-                jellyfin_musicbrain_trackid_update(jellyfin_server, item, musicbrainz_track_data[m_indx]['tracks'][jf_indx-1], musicbrainz_track_data)
+                jellyfin_musicbrain_trackid_update(jellyfin_server, item, musicbrainz_track, musicbrainz_track_data, disc_index=disc_index)
             else:
-                if m_indx == 0:
+                if first_track == None:
                     first_track = item
-                jellyfin_musicbrain_trackid_update(jellyfin_server, item, musicbrainz_track_data[m_indx]['tracks'][jf_indx-1], musicbrainz_track_data, first_track)
-        # Check of the item index is higher than the number of tracks in the disc
-        if jf_indx >= int(disc_track_count):
-            m_indx += 1
-            jf_indx = 0
+                jellyfin_musicbrain_trackid_update(jellyfin_server, item, musicbrainz_track, musicbrainz_track_data, first_track, disc_index)
     return
         
 def jellyfin_search_musicbrainz_track_id_exists(album_tracks):
@@ -681,20 +2255,6 @@ def jellyfin_search_musicbrainz_track_id_exists(album_tracks):
             return True
     return False
 
-def unnest_items(item, key, item_type="Audio"):
-    # A function to unnest all dicts and return a single list of dicts
-    items_list=[]
-    if type(item) == dict or type(item) == list or type(item) == tuple:
-        for k in item:
-            if type(k) == list:
-                items_list += unnest_items(k, key, item_type)      
-            if type(k) == dict:
-                if key in k:
-                    if type(k) == dict:
-                        if k["Type"] == item_type:
-                            items_list.append(k)
-    return items_list
-
 def sort_tracks_by_index_number(album_tracks):
     # Sort the album tracks by IndexNumber
     album_tracks.sort(key=lambda x: x["IndexNumber"])
@@ -703,18 +2263,22 @@ def sort_tracks_by_index_number(album_tracks):
         album_tracks.sort(key=lambda x: x["ParentIndexNumber"])
     return album_tracks
 
-def process_album(album):
+def album_prepare(album):
+    # Get everything needed to verify and update the album
+    # Returns the result if the album is skipped, otherwise the album context used by album_verify and album_write
+    started = time.monotonic()
     album_artist_id=get_album_musicbrains_ids(jellyfin_server, jellyfin_api_key, album)
     # skip albums without a musicbrainz album id
     # check if first item in tuple is a boolean
     if isinstance(album_artist_id[0], bool):
         if not album_artist_id[0]:
             print(f"No musicbrainz album id found for album: {album_artist_id[1]}, {album}, Skipping")
+            phase_add("fetch", time.monotonic() - started)
             return False, album_artist_id[1], "NOALBUMMBID"
     
     print(f"Getting tracks data for album: {album} from jellyfin server: {jellyfin_server}")
 
-    album_tracks=get_album_tracks(jellyfin_server, jellyfin_api_key, album)
+    album_tracks=album_tracks_lookup(album)
     if merge != None:
         if type(merge) == list:
             for album_id in merge:
@@ -728,132 +2292,782 @@ def process_album(album):
         print(f"Folders: {folders}")
         print(f"Album: {album}")
 
-        # Nest once because I am too lazy to fix test the unnest_items function in multi scenarios
-        tracks=[]
-        tracks.append(album_tracks)
-        album_tracks=tracks
-    #print(json.dumps(album_tracks, indent=4))
     # Check if the track in the album contains a musicbrainz track id and is Type Audio and contains Audio key
-    album_tracks=unnest_items(album_tracks[0], "Name", "Audio")
+    album_tracks=flatten_items(album_tracks, "Name", "Audio")
     print(f"Getting musicbrainz track data for album: {album_artist_id[2]}, {album_artist_id[0]} from musicbrainz server: {musicbrainz_server}")
     musicbrainz_track_data=get_musicbrainz_track_ids(musicbrainz_server, album_artist_id[0])
 
-    global sort_alpha
+    album_sort_alpha = sort_alpha
     for track in album_tracks:
-        if "02-01" in track["MediaSources"][0]["Path"]:
-            sort_alpha=True
+        if "02-01" in track.get("Path", ""):
+            album_sort_alpha=True
             break
 
-    if sort_alpha:
-        album_tracks.sort(key=lambda x: x["MediaSources"][0]["Path"])
-    
-    #print(json.dumps(musicbrainz_track_data, indent=4))
+    if album_sort_alpha:
+        album_tracks.sort(key=lambda x: x.get("Path", ""))
+
+    if verify and album_tracks == []:
+        print("Multi disc album detected, unnesting")
+        nested_albums=get_multi_disc_children(jellyfin_server, jellyfin_api_key, album)
+        for item in nested_albums:
+            if item["Type"] == 'Folder':
+                nested_album_tracks=get_album_tracks(jellyfin_server, jellyfin_api_key, item["Id"])
+                album_tracks+=flatten_items(nested_album_tracks, "Name", "Audio")
+        album_tracks=flatten_items(album_tracks, "Name", "Audio")
+
+    phase_add("fetch", time.monotonic() - started)
+    matches = []
+    if type(album_tracks) == list and "media" in musicbrainz_track_data:
+        with phase_timer("match"):
+            matches = match_album_tracks(album_tracks, musicbrainz_track_data["media"])
+
+    return {
+        "album": album,
+        "album_artist_id": album_artist_id,
+        "album_tracks": album_tracks,
+        "musicbrainz_track_data": musicbrainz_track_data,
+        "matches": matches
+    }
+
+def album_verify(context):
     # Show information from both musicbrainz and jellyfin for comparison and confirmation
-    if verify:
-        if album_tracks == []:
-            print("Multi disc album detected, unnesting")
-            nested_albums=get_multi_disc_children(jellyfin_server, jellyfin_api_key, album)
-            for item in nested_albums:
-                if item["Type"] == 'Folder':
-                    nested_album_tracks=get_album_tracks(jellyfin_server, jellyfin_api_key, item["Id"])
-                    album_tracks+=unnest_items(nested_album_tracks, "Name", "Audio")
-            album_tracks=unnest_items(album_tracks, "Name", "Audio")
-
-        # check the first and last track are lists
-        if type(album_tracks) != list or album_tracks == []:
-            print("Error: There was a problem retrieving the metadata from Jellyfin")
-            return False, album_artist_id[2], "METADATARETRIEVALERROR"
-        
-        first_track=album_tracks
-        last_track=album_tracks
-
-        #print(json.dumps(musicbrainz_track_data['media'], indent=4))
-        # Check the Name key exists for first and last track
-        if  "Name" not in first_track[0] or "Name" not in last_track[-1]:
-            print("Error: There was a problem retrieving the metadata from Jellyfin")
-            return False, album_artist_id[2], "METADATARETRIEVALERROR"
-        # Compare album titles
-        print(f"album title; Jellyfin  : {album_artist_id[2]}, Musicbrainz: {musicbrainz_track_data['title']}")
-        # Compare first track
-        print(f"first track; Jellyfin  : {first_track[0]['Name']}, Musicbrainz: {musicbrainz_track_data['media'][0]['tracks'][0]['recording']['title']}")
-        # Compare last track
-        print(f"last track; Jellyfin   : {last_track[-1]['Name']}, Musicbrainz: {musicbrainz_track_data['media'][-1]['tracks'][-1]['recording']['title']}")
-        # Compare number of tracks
-        # Get the number of tracks from each disc on musicbrainz and add them together
-        mb_tracks=0
-        for disc in musicbrainz_track_data['media']:
-            mb_tracks += int(disc['track-count'])
-        print(f"number of tracks; Jellyfin: {len(album_tracks)}, Musicbrainz: {mb_tracks}")
-        if "MusicBrainzTrack" in first_track[0]["ProviderIds"] and "MusicBrainzTrack" in last_track[-1]["ProviderIds"]:
-                print(f"MusicBrainzTrack already set for tracks in this album")
-                if skip_existing:
-                    print("Skipping")
-                    return False, album_artist_id[2], "ALREADYSET"
-        # Check if album if Vinyl
-        print(musicbrainz_track_data["media"][0]["format"])
-        if musicbrainz_track_data["media"][0]["format"] != None:
-            if "Vinyl" in musicbrainz_track_data["media"][0]["format"]:
-                # Prompt and accept all input to continue
+    # Returns the result if the album is skipped or None if the update was confirmed
+    album_artist_id = context["album_artist_id"]
+    album_tracks = context["album_tracks"]
+    musicbrainz_track_data = context["musicbrainz_track_data"]
+    # check the first and last track are lists
+    if type(album_tracks) != list or album_tracks == []:
+        print("Error: There was a problem retrieving the metadata from Jellyfin")
+        return False, album_artist_id[2], "METADATARETRIEVALERROR"
+    
+    first_track=album_tracks
+    last_track=album_tracks
+
+    #print(json.dumps(musicbrainz_track_data['media'], indent=4))
+    # Check the Name key exists for first and last track
+    if  "Name" not in first_track[0] or "Name" not in last_track[-1]:
+        print("Error: There was a problem retrieving the metadata from Jellyfin")
+        return False, album_artist_id[2], "METADATARETRIEVALERROR"
+    # Compare album titles
+    print(f"album title; Jellyfin  : {album_artist_id[2]}, Musicbrainz: {musicbrainz_track_data['title']}")
+    # Compare first track
+    print(f"first track; Jellyfin  : {first_track[0]['Name']}, Musicbrainz: {musicbrainz_track_data['media'][0]['tracks'][0]['recording']['title']}")
+    # Compare last track
+    print(f"last track; Jellyfin   : {last_track[-1]['Name']}, Musicbrainz: {musicbrainz_track_data['media'][-1]['tracks'][-1]['recording']['title']}")
+    # Compare number of tracks
+    # Get the number of tracks from each disc on musicbrainz and add them together
+    mb_tracks=0
+    for disc in musicbrainz_track_data['media']:
+        mb_tracks += int(disc['track-count'])
+    print(f"number of tracks; Jellyfin: {len(album_tracks)}, Musicbrainz: {mb_tracks}")
+    # Only the tracks that could not be matched with confidence need checking
+    low_confidence = match_low_confidence(context["matches"])
+    if low_confidence:
+        print(f"{len(low_confidence)} tracks could not be matched with confidence and will not be updated:")
+        for item, musicbrainz_track, disc_index, confidence in low_confidence:
+            if musicbrainz_track == None:
+                print(f"  Jellyfin: {item['Name']}, Musicbrainz: None")
+            else:
+                print(f"  Jellyfin: {item['Name']}, Musicbrainz: {musicbrainz_track['title']}, confidence: {confidence}")
+    if "MusicBrainzTrack" in first_track[0]["ProviderIds"] and "MusicBrainzTrack" in last_track[-1]["ProviderIds"]:
+        print(f"MusicBrainzTrack already set for tracks in this album")
+        if skip_existing:
+            print("Skipping")
+            return False, album_artist_id[2], "ALREADYSET"
+    # Check if album if Vinyl
+    print(musicbrainz_track_data["media"][0]["format"])
+    if musicbrainz_track_data["media"][0]["format"] != None:
+        if "Vinyl" in musicbrainz_track_data["media"][0]["format"]:
+            # Prompt and accept all input to continue
+            with phase_timer("verify-wait"):
                 confirmation = input("This script does not work with Vinyl Albums, Are you sure Jellyfin detected album MBID correctly?:")
-                print("Aborting")
-                return False, album_artist_id[2], "VINYL"
-        if merge != None:
-            print("Merge currently does not work as intended (Does not merge), it will however update all the albums with the correct metabrainz track ids.")
-        confirmation = input("Confirm? [y/N]: ")
-        if confirmation.lower() != "y":
             print("Aborting")
-            return False, album_artist_id[2], "ABORTED"
-    print(f"Updating album: {album_artist_id[1]}, {album} with musicbrainz track ids")
-    jellyfin_album_musicbrainz_trackid_update(jellyfin_server, album_tracks, musicbrainz_track_data['media'])
+            return False, album_artist_id[2], "VINYL"
+    if merge != None:
+        print("Merge currently does not work as intended (Does not merge), it will however update all the albums with the correct metabrainz track ids.")
+    with phase_timer("verify-wait"):
+        confirmation = input("Confirm? [y/N]: ")
+    if confirmation.lower() != "y":
+        print("Aborting")
+        return False, album_artist_id[2], "ABORTED"
+    return None
+
+def album_write(context):
+    album_artist_id = context["album_artist_id"]
+    print(f"Updating album: {album_artist_id[1]}, {context['album']} with musicbrainz track ids")
+    with phase_timer("write"), album_writes(context["album"]):
+        jellyfin_album_musicbrainz_trackid_update(jellyfin_server, context["matches"], context["musicbrainz_track_data"]['media'])
 
     #print(get_single_track_info(jellyfin_server, jellyfin_api_key, jellyfin_album_id))
     return True, album_artist_id[2], "UPDATED"
 
-skipped_albums = []
-print("This relies on the MBID for the album being correctly set in jellyfin")
-print("Sometimes the metabrainz plugin does not detect the MBID correctly, in this case you will have to manually set it in jellyfin.")
-print("By default the script will output a comparison of the album and tracks from jellyfin and musicbrainz for confirmation")
-print("Enter username and password for jellyfin server")
-tokens=prompt_for_username_password()
-if sys.argv[1] != "all":
-    jellyfin_album_id = sys.argv[1]
-    if new_playlist_name != None:
-        shuffle_playlist(jellyfin_album_id)
-        exit()
-    if update_genre:
-        if not get_album_musicbrains_ids(jellyfin_server, jellyfin_api_key, jellyfin_album_id)[0]:
-            print("No musicbrainz album id found, skipping")
-            exit()
-        jellyfin_genre_update(jellyfin_album_id)
-        exit()
-    process_album(jellyfin_album_id)
-elif sys.argv[1] == "all":
+def process_album(album):
+    context = album_prepare(album)
+    if type(context) == tuple:
+        return context
+    if verify:
+        result = album_verify(context)
+        if result != None:
+            return result
+    return album_write(context)
+
+def album_genre_update(album):
+    # Update the genres for an album from the album listing
+    album_ids = get_album_musicbrains_ids(jellyfin_server, jellyfin_api_key, album["Id"])
+    if not album_ids[0]:
+        print(f'No musicbrainz album id found for album: {album["Name"]}, {album["Id"]}, Skipping')
+        return False, album["Name"], "NOALBUMMBID"
+    with album_writes(album["Id"]):
+        current_album=jellyfin_genre_update(album["Id"], album_ids)
+    print(f"Updated genres for album: {current_album[1]}")
+    return current_album
+
+def group_albums_by_artist(albums):
+    # Group each run of albums with the same musicbrainz album artist, the listing is sorted by album artist so the groups are made as the pages arrive
+    # Albums without an artist id are each processed on their own
+    group = []
+    group_artist = None
+    for album in albums:
+        artist = album.get("ProviderIds", {}).get("MusicBrainzAlbumArtist")
+        artist = artist.lower() if artist != None else None
+        if len(group) > 0 and (artist == None or artist != group_artist):
+            yield group
+            group = []
+        if len(group) == 0 and artist != None:
+            stat_add("artist groups")
+        group.append(album)
+        group_artist = artist
+    if len(group) > 0:
+        yield group
+
+def artist_genre_update(artist_albums):
+    # Update the genres of one artist's albums, the artist genres are looked up for the first album and the rest come from the musicbrainz memo
+    return [(album, album_genre_update(album)) for album in artist_albums]
+
+class ThreadOutput:
+    # Replacement for sys.stdout, threads that are capturing output write to their own buffer instead of the terminal
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer != None:
+            buffer.append(text)
+            return len(text)
+        with self.lock:
+            return self.stream.write(text)
+
+    def write_block(self, text):
+        # Write a block of captured output without other threads writing in the middle of it
+        with self.lock:
+            self.stream.write(text)
+            self.stream.flush()
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def collect_output(function, *args):
+    # Run the function with its output collected, returns the result and the output
+    # If the function fails the output is printed straight away so the error is not lost
+    sys.stdout.local.buffer = []
+    try:
+        result = function(*args)
+    except BaseException:
+        sys.stdout.write_block("".join(sys.stdout.local.buffer))
+        raise
+    finally:
+        output = "".join(sys.stdout.local.buffer)
+        sys.stdout.local.buffer = None
+    return result, output
+
+def capture_output(function, *args):
+    # Run the function with its output collected, the output is printed in one piece when the function finishes
+    result, output = collect_output(function, *args)
+    sys.stdout.write_block(output)
+    return result
+
+def run_albums(albums, album_function):
+    # Run album_function for each album and yield each album with its result
+    # With more than one worker the albums are processed at the same time, musicbrainz requests are still rate limited across all workers
+    if workers <= 1:
+        for album in albums:
+            yield album, album_function(album)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for album in albums:
+            pending[executor.submit(capture_output, album_function, album)] = album
+            # Only read ahead a little so the album listing is still streamed
+            if len(pending) >= workers * 2:
+                done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+                for future in done:
+                    yield pending.pop(future), future.result()
+        for future in concurrent.futures.as_completed(pending):
+            yield pending[future], future.result()
+
+def run_albums_prefetch(albums):
+    # Process albums with confirmation, the next albums are prepared in the background while waiting for confirmation
+    # Confirmed albums are updated in the background, their output is shown before the next comparison
+    with concurrent.futures.ThreadPoolExecutor(max_workers=prefetch) as preparer, concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+        albums = iter(albums)
+        prepared = collections.deque()
+        writes = []
+        while True:
+            # Keep the next albums being prepared
+            while len(prepared) < prefetch + 1:
+                album = next(albums, None)
+                if album == None:
+                    break
+                prepared.append((album, preparer.submit(collect_output, album_prepare, album["Id"])))
+            # Show the output of finished updates before the next comparison
+            for write in [write for write in writes if write[1].done()]:
+                writes.remove(write)
+                result, output = write[1].result()
+                sys.stdout.write_block(output)
+                yield write[0], result
+            if len(prepared) == 0:
+                break
+            album, future = prepared.popleft()
+            context, output = future.result()
+            sys.stdout.write_block(output)
+            if type(context) == tuple:
+                yield album, context
+                continue
+            result = album_verify(context)
+            if result != None:
+                yield album, result
+                continue
+            writes.append((album, writer.submit(collect_output, album_write, context)))
+        for album, write in writes:
+            result, output = write.result()
+            sys.stdout.write_block(output)
+            yield album, result
+
+# Results that mean the album does not have to be processed again when resuming
+journal_finished_results = ["UPDATED", "ALREADYSET", "NOALBUMMBID", "VINYL", "ABORTED", "GENREUPDATED", "GENRESKIPPED"]
+journal_lock = threading.Lock()
+journal_handle = None
+# Start time of this run, also used to identify the run in the journal
+journal_run = None
+
+def journal_path():
+    if journal_file != None:
+        return journal_file
+    return cache_file("journal", "jsonl")
+
+def journal_write(entry):
+    # Append one line to the journal, it is flushed straight away so it survives a crash
+    global journal_handle
+    with journal_lock:
+        if journal_handle == None:
+            os.makedirs(os.path.dirname(os.path.abspath(journal_path())), exist_ok=True)
+            journal_handle = open(journal_path(), "a+")
+            # Finish a line left partly written by a crash so it does not swallow the next entry
+            if journal_handle.tell() > 0:
+                journal_handle.seek(journal_handle.tell() - 1)
+                if journal_handle.read(1) != "\n":
+                    journal_handle.write("\n")
+        journal_handle.write(json.dumps(entry) + "\n")
+        journal_handle.flush()
+
+def journal_read():
+    # Return all the journal entries, a partly written last line from a crash is ignored
+    entries = []
+    if not os.path.exists(journal_path()):
+        return entries
+    with open(journal_path()) as journal:
+        for line in journal:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+def journal_start(mode):
+    global journal_run
+    journal_run = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    journal_write({"event": "start", "run": journal_run, "mode": mode})
+
+def journal_record(mode, album, result):
+    journal_write({"event": "album", "run": journal_run, "mode": mode, "album": album["Id"], "name": result[1], "result": result[-1]})
+
+def journal_record_after_writes(mode, album, result):
+    # Journal an album once its queued updates are sent, a killed run leaves the album out of the journal so --resume retries it
+    with write_condition:
+        if album["Id"] in write_pending:
+            write_journal_waiting[album["Id"]] = (mode, album, result)
+            return
+    journal_record_written(mode, album, result)
+
+def journal_record_written(mode, album, result):
+    # An album with an update that could not be sent is not finished
+    if album["Id"] in write_failed_albums:
+        result = (False, result[1], "WRITEFAILED")
+    journal_record(mode, album, result)
+
+def journal_complete(mode):
+    # Every update has been sent by now, so the albums this run wrote were saved before the finish time
+    # The time keeps the microseconds so albums saved in the last second of the run are not listed again
+    finished = time.time()
+    journal_write({"event": "complete", "run": journal_run, "mode": mode,
+                   "finished": f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(finished))}.{int(finished % 1 * 1000000):06d}Z"})
+
+def journal_last_complete_run(mode):
+    # Return the finish time of the last run that completed, journals from before the finish time was kept use the start time
+    last_run = None
+    for entry in journal_read():
+        if entry["event"] == "complete" and entry["mode"] == mode:
+            last_run = entry.get("finished", entry["run"])
+    return last_run
+
+def journal_skip_completed(albums, mode):
+    # Skip the albums finished since the last run that completed
+    finished = set()
+    for entry in journal_read():
+        if entry["mode"] != mode:
+            continue
+        if entry["event"] == "complete":
+            finished = set()
+        elif entry["event"] == "album" and entry["result"] in journal_finished_results:
+            finished.add(entry["album"])
+    print(f"Resuming, {len(finished)} albums have already been processed")
+    for album in albums:
+        if album["Id"] in finished:
+            stat_add("albums skipped by --resume")
+            continue
+        yield album
+
+def shard_contains(jellyfin_album_id):
+    # The crc32 of the album id always puts an album in the same shard
+    return zlib.crc32(jellyfin_album_id.encode()) % shard_count == shard_index - 1
+
+def shard_albums(albums):
+    # Keep the albums in this shard
+    for album in albums:
+        if shard_contains(album["Id"]):
+            yield album
+
+# Results of this shard, written when the run ends so merge-shards can combine them with the other shards
+shard_results = None
+
+def shard_results_path(index, shards):
+    return os.path.join(cache_dir, f"shard-{index}-of-{shards}.json")
+
+def shard_results_write():
+    if shard_results == None:
+        return
+    shard_results["stats"] = {name: value for name, value in run_stats.items() if type(value) in (int, float)}
+    write_file_atomic(shard_results_path(shard_index, shard_count), json.dumps(shard_results, indent=1))
+
+run_stats_hooks.append(shard_results_write)
+
+def merge_shards():
+    # Combine the results of the shards from the last sharded run into one report
+    paths = glob.glob(os.path.join(cache_dir, "shard-*-of-*.json"))
+    if len(paths) == 0:
+        print(f"Error: No shard results found in {cache_dir}")
+        sys.exit(1)
+    shards = int(re.search(r"-of-(\d+)\.json$", max(paths, key=os.path.getmtime)).group(1))
+    merged = {"shards": shards, "runs": {}, "missing": [], "results": {}, "skipped": [], "stats": {}}
+    for index in range(1, shards + 1):
+        path = shard_results_path(index, shards)
+        if not os.path.exists(path):
+            merged["missing"].append(index)
+            continue
+        with open(path) as shard_file:
+            results = json.load(shard_file)
+        merged["runs"][index] = f"{results['mode']} {results['run']}"
+        for result, number in results["results"].items():
+            merged["results"][result] = merged["results"].get(result, 0) + number
+        merged["skipped"].extend(results["skipped"])
+        for name, value in results["stats"].items():
+            merged["stats"][name] = merged["stats"].get(name, 0) + value
+    write_file_atomic(report_file or os.path.join(cache_dir, "shard_report.json"), json.dumps(merged, indent=1))
+    for index, run in merged["runs"].items():
+        print(f"Shard {index}/{shards}: {run}")
+    if len(merged["missing"]) > 0:
+        print(f"Missing shards: {', '.join(str(index) for index in merged['missing'])}")
+    print("Results:")
+    for result, number in sorted(merged["results"].items()):
+        print(f"  {result}: {number}")
+    print("Skipped albums:")
+    for album in merged["skipped"]:
+        print(album)
+
+def synthetic_tracks_json(first, track_count):
+    # A page of tracks shaped like the jellyfin response for the track index, for measuring memory use
+    tracks = []
+    for number in range(first, first + track_count):
+        album = number // 12
+        artist = album // 4
+        path = f"/music/Artist {artist}/Album {album}/{number % 12 + 1:02d} Track {number % 12 + 1}.flac"
+        tracks.append({
+            "Name": f"Track {number}", "ServerId": "0" * 32, "Id": f"{number:032x}", "Type": "Audio", "MediaType": "Audio",
+            "IndexNumber": number % 12 + 1, "ParentIndexNumber": 1, "RunTimeTicks": 2400000000 + number, "ProductionYear": 2000,
+            "Album": f"Album {album}", "AlbumId": f"{album:032x}", "ParentId": f"{album:032x}", "Path": path,
+            "AlbumArtist": f"Artist {artist}", "AlbumArtists": [{"Name": f"Artist {artist}", "Id": f"{artist:032x}"}],
+            "ArtistItems": [{"Name": f"Artist {artist}", "Id": f"{artist:032x}"}], "Artists": [f"Artist {artist}"],
+            "ProviderIds": {"MusicBrainzTrack": f"{number:08x}-0000-0000-0000-000000000000"}, "Genres": ["Rock"], "Tags": [], "Studios": [],
+            "ImageBlurHashes": {"Primary": {"0" * 32: "LKO2?U%2Tw=w]~RBVZRi};RPxuwH"}},
+            "UserData": {"PlaybackPositionTicks": 0, "PlayCount": 3, "IsFavorite": False, "Played": True, "Key": f"{number:032x}"},
+            "MediaSources": [{"Protocol": "File", "Id": f"{number:032x}", "Path": path, "Type": "Default", "Container": "flac",
+                              "Size": 30000000, "Name": f"Track {number}", "IsRemote": False, "RunTimeTicks": 2400000000 + number,
+                              "MediaStreams": [{"Codec": "flac", "TimeBase": "1/44100", "Type": "Audio", "Channels": 2, "SampleRate": 44100,
+                                                "BitDepth": 16, "Index": 0, "DisplayTitle": "FLAC - Stereo", "BitRate": 900000}]}]
+        })
+    return json.dumps({"Items": tracks})
+
+def object_size(objects):
+    # Bytes used by the objects and everything they refer to, objects shared between them are counted once
+    seen = set()
+    total = 0
+    stack = list(objects)
+    while stack:
+        value = stack.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        total += sys.getsizeof(value)
+        if type(value) == dict:
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif type(value) == list or type(value) == tuple:
+            stack.extend(value)
+        elif isinstance(value, Record):
+            stack.extend(getattr(value, key) for key in value.__slots__)
+    return total
+
+def track_memory_report(track_count):
+    # Measure the memory used by the track index for a synthetic library
+    # The raw json is measured on a sample because keeping all of it can use more memory than the machine has
+    sample_count = min(track_count, 20000)
+    raw = json.loads(synthetic_tracks_json(0, sample_count))["Items"]
+    raw_bytes = object_size(raw)
+    del raw
+
+    start_time = time.time()
+    index = {}
+    for first in range(0, track_count, track_page_size):
+        page = json.loads(synthetic_tracks_json(first, min(track_page_size, track_count - first)))["Items"]
+        for track in tracks_from_json(page):
+            index.setdefault(track.get("AlbumId"), []).append(track)
+        del page
+    build_time = time.time() - start_time
+    record_bytes = object_size([index])
+    print(f"Tracks: {track_count}")
+    print(f"Raw json: {raw_bytes / sample_count:.0f} bytes per track, about {raw_bytes / sample_count * track_count / 1048576:.0f} MB for every track (measured on {sample_count} tracks)")
+    print(f"Track index: {record_bytes / track_count:.0f} bytes per track, {record_bytes / 1048576:.0f} MB for every track")
+    print(f"Built in {build_time:.1f} seconds")
+
+# Commands that do not log in to jellyfin
+local_commands = ["track-memory", "merge-shards", "musicbrainz-import"]
+
+def run_command():
+    # Run the command or album in jellyfin_album_id with the options set by parse_args
+    global shard_results
+    if jellyfin_album_id == "track-memory":
+        track_memory_report(memory_test_tracks)
+        return
+    if jellyfin_album_id == "merge-shards":
+        merge_shards()
+        return
+    if jellyfin_album_id == "musicbrainz-import":
+        if len(musicbrainz_dump_files) == 0:
+            print("Error: You must specify the dump files to import with --dump")
+            sys.exit(1)
+        musicbrainz_dump_import(musicbrainz_dump_files)
+        return
+    skipped_albums = []
+    if jellyfin_album_id != "all":
+        if new_playlist_name != None:
+            shuffle_playlist(jellyfin_album_id)
+            return
+        if update_genre:
+            album_ids = get_album_musicbrains_ids(jellyfin_server, jellyfin_api_key, jellyfin_album_id)
+            if not album_ids[0]:
+                print("No musicbrainz album id found, skipping")
+                return
+            jellyfin_genre_update(jellyfin_album_id, album_ids)
+            write_queue_drain()
+            return
+        process_album(jellyfin_album_id)
+        write_queue_drain()
+        return
     if merge:
         print("Merge cannot be used with all")
         sys.exit(1)
-    albums = get_albums(jellyfin_server)
+    run_mode = "genre" if update_genre else "trackid"
+    min_date_last_saved = None
+    if since:
+        min_date_last_saved = journal_last_complete_run(run_mode)
+        if min_date_last_saved == None:
+            print("Error: --since needs a previous run that finished, run without --since first")
+            sys.exit(1)
+        print(f"Only processing albums added or changed since: {min_date_last_saved}")
+    journal_start(run_mode)
+    # Grouping by artist needs each artist's albums to be listed together
+    albums = get_albums(jellyfin_server, min_date_last_saved, "AlbumArtist,SortName" if update_genre and group_by_artist else "SortName")
+    if shard_count > 1:
+        print(f"Processing shard {shard_index} of {shard_count}")
+        albums = shard_albums(albums)
+        shard_results = {"mode": run_mode, "run": journal_run, "results": {}, "skipped": []}
+    result_counts = collections.Counter()
+    if resume:
+        albums = journal_skip_completed(albums, run_mode)
+    if not update_genre and use_track_index:
+        albums = track_index_albums(albums)
     print("Processing all albums")
     if update_genre:
-        for album in albums:
-            # Wait 1 second to prevent rate limiting
-            time.sleep(1)
-            if not get_album_musicbrains_ids(jellyfin_server, jellyfin_api_key, album["Id"])[0]:
-                print(f'No musicbrainz album id found for album: {album["Name"]}, {album["Id"]}, Skipping')
-                skipped_albums.append(album["Name"])
-                continue
-            current_album=jellyfin_genre_update(album["Id"])
-            print(f"Updated genres for album: {current_album[1]}")
+        if use_musicbrainz_batch and musicbrainz_backend == "online":
+            albums = musicbrainz_batch_albums(albums)
+        if group_by_artist:
+            album_results = (result for artist_albums, results in run_albums(group_albums_by_artist(albums), artist_genre_update) for result in results)
+        else:
+            album_results = run_albums(albums, album_genre_update)
+        for album, current_album in album_results:
+            journal_record_after_writes(run_mode, album, current_album)
+            result_counts[current_album[-1]] += 1
             if not current_album[0]:
                 skipped_albums.append(current_album[1])
+        write_queue_drain()
+        journal_complete(run_mode)
+        if shard_results != None:
+            shard_results.update(results=result_counts, skipped=skipped_albums)
         print("Skipped albums:")
         for album in skipped_albums:
             print(album)
-        exit()
-    for album in albums:
-        current_album=process_album(album["Id"])
+        return
+    if verify and prefetch > 0:
+        album_results = run_albums_prefetch(albums)
+    else:
+        album_results = run_albums(albums, lambda album: process_album(album["Id"]))
+    for album, current_album in album_results:
+        journal_record_after_writes(run_mode, album, current_album)
+        result_counts[current_album[-1]] += 1
         if not current_album[0]:
             skipped_albums.append({current_album[1], current_album[2]})
+    write_queue_drain()
+    journal_complete(run_mode)
+    if shard_results != None:
+        shard_results.update(results=result_counts, skipped=[list(album) for album in skipped_albums])
     # Print skipped albums
     print("Skipped albums:")
     for album in skipped_albums:
-        print(album)
\ No newline at end of file
+        print(album)
+# Daemon mode, the daemon logs in once and runs the jobs sent by submit one at a time
+# The http sessions, rate limit buckets, musicbrainz cache connection and genre list stay ready between jobs
+# Options that change what the daemon keeps between jobs, they can only be given when starting the daemon
+daemon_only_options = ["--cache-dir", "--no-cache", "--cache-size", "--pool-size", "--timeout", "--shard", "--profile", "--socket"]
+# Settings that options can change, each job starts from the settings the daemon was started with
+job_settings = ["album_page_size", "playlist_page_size", "playlist_batch_size", "use_track_index", "track_page_size",
+                "rate_limits", "http_retries", "use_write_queue", "write_concurrency", "write_latency_target", "refresh_cache",
+                "use_musicbrainz_batch", "musicbrainz_batch_size", "musicbrainz_backend", "musicbrainz_dump_db", "musicbrainz_dump_files"]
+
+def daemon_socket_path():
+    return daemon_socket or os.path.join(cache_dir, "daemon.sock")
+
+def daemon_job_reset(settings):
+    # Forget everything the last job found out about the library, jellyfin may have changed since
+    global metrics_started, journal_handle, shard_results, session_login_failed
+    for name, value in copy.deepcopy(settings).items():
+        globals()[name] = value
+    run_stats.clear()
+    metrics_endpoints.clear()
+    metrics_phases.clear()
+    metrics_started = time.time()
+    musicbrainz_memo.clear()
+    musicbrainz_memo_key_locks.clear()
+    album_store.clear()
+    track_index.clear()
+    write_failures.clear()
+    write_times.clear()
+    write_pending.clear()
+    write_failed_albums.clear()
+    write_journal_waiting.clear()
+    if journal_handle != None:
+        journal_handle.close()
+        journal_handle = None
+    shard_results = None
+    session_login_failed = False
+    with rate_buckets_lock:
+        for bucket in rate_buckets.values():
+            bucket["requests"] = 0
+            bucket["first"] = time.monotonic()
+
+def daemon_job(connection, settings):
+    # Run one job with its output sent to the connection, input is read from the connection for confirmations
+    # The job ends with a NUL byte and its exit code
+    reader = connection.makefile("r", encoding="utf-8")
+    writer = connection.makefile("w", encoding="utf-8", buffering=1)
+    try:
+        args = json.loads(reader.readline())["args"]
+    except (ValueError, KeyError):
+        return
+    print(f"Job: {' '.join(args)}")
+    terminal_stdin, terminal_stream = sys.stdin, sys.stdout.stream
+    sys.stdin, sys.stdout.stream = reader, writer
+    exit_code = 0
+    try:
+        not_allowed = [arg for arg in args if arg.split("=")[0] in daemon_only_options]
+        if len(not_allowed) > 0:
+            print(f"Error: {', '.join(not_allowed)} can only be used when starting the daemon")
+            exit_code = 1
+        elif args[:1] == ["daemon"] or args[:1] == ["submit"]:
+            print(f"Error: {args[0]} cannot be sent to the daemon")
+            exit_code = 1
+        else:
+            daemon_job_reset(settings)
+            try:
+                parse_args(args)
+                musicbrainz_dump_check()
+                run_command()
+            finally:
+                write_queue_drain(False)
+                print_run_stats()
+    except SystemExit as err:
+        exit_code = err.code if type(err.code) == int else 0 if err.code == None else 1
+    except EOFError:
+        print("Error: A confirmation was needed but submit has no more input")
+        exit_code = 1
+    except OSError as err:
+        # The client went away, there is nobody to send the rest of the output to
+        exit_code = None
+        terminal_stream.write(f"Error: Lost the connection to submit: {err}\n")
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        exit_code = 1
+    finally:
+        sys.stdin, sys.stdout.stream = terminal_stdin, terminal_stream
+    if exit_code != None:
+        try:
+            writer.write(f"\0exit {exit_code}\n")
+            writer.flush()
+        except OSError:
+            pass
+    # The connection is only closed once the files made from it are closed
+    reader.close()
+    writer.close()
+    print(f"Job finished with exit code {exit_code}")
+
+def daemon_serve():
+    # Listen for jobs until the daemon is stopped with Ctrl+C or SIGTERM
+    settings = copy.deepcopy({name: globals()[name] for name in job_settings})
+    path = daemon_socket_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if os.path.exists(path):
+        try:
+            socket.socket(socket.AF_UNIX, socket.SOCK_STREAM).connect(path)
+            print(f"Error: A daemon is already listening on {path}")
+            sys.exit(1)
+        except ConnectionRefusedError:
+            # Left behind by a daemon that did not shut down cleanly
+            os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Jobs can change the library, so only the user running the daemon can connect
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen()
+    # Stopping the daemon from a service manager removes the socket the same way as Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"Waiting for jobs on {path}")
+    try:
+        while True:
+            connection, address = server.accept()
+            with connection:
+                daemon_job(connection, settings)
+    except KeyboardInterrupt:
+        print("Stopping the daemon")
+    finally:
+        server.close()
+        os.remove(path)
+        # Nothing is left to report when the daemon exits
+        daemon_job_reset(settings)
+
+def daemon_submit(argv):
+    # Send a job to the daemon and show its output as it arrives, returns the exit code of the job
+    # Lines typed in the terminal are passed on to the daemon so confirmations work as usual
+    # The options are sent to the daemon as they are, except --socket and --cache-dir which are only used to find the daemon
+    path = None
+    submit_cache_dir = cache_dir
+    args = []
+    options = iter(argv)
+    for arg in options:
+        name, has_value, value = arg.partition("=")
+        if name in ["--socket", "--cache-dir"]:
+            if not has_value:
+                value = next(options, "")
+            if name == "--socket":
+                path = value
+            else:
+                submit_cache_dir = value
+        else:
+            args.append(arg)
+    if path == None:
+        path = os.path.join(submit_cache_dir, "daemon.sock")
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError as err:
+        print(f"Error: Could not connect to the daemon on {path}, start it with: jellyfin_meta_data_updater.py daemon ({err})")
+        return 1
+    client.sendall((json.dumps({"args": args}) + "\n").encode())
+    def send_input():
+        try:
+            for line in sys.stdin:
+                client.sendall(line.encode())
+            # Let the daemon know there are no more answers coming
+            client.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+    threading.Thread(target=send_input, daemon=True).start()
+    status = None
+    while True:
+        data = client.recv(65536)
+        if len(data) == 0:
+            break
+        if status == None:
+            output, end, status = data.partition(b"\0")
+            sys.stdout.buffer.write(output)
+            sys.stdout.buffer.flush()
+            if not end:
+                status = None
+        else:
+            status += data
+        if status != None and status.endswith(b"\n"):
+            break
+    client.close()
+    if status == None:
+        print("Error: The daemon stopped before the job finished")
+        return 1
+    return int(status.split()[1])
+
+def main(argv):
+    # Worker threads collect their output through sys.stdout, it is only replaced when running the script so importing it changes nothing
+    if not isinstance(sys.stdout, ThreadOutput):
+        sys.stdout = ThreadOutput(sys.stdout)
+    if argv[:1] == ["submit"]:
+        sys.exit(daemon_submit(argv[1:]))
+    parse_args(argv)
+    if profile_run:
+        threading.Thread(target=profile_sampler, daemon=True).start()
+    musicbrainz_dump_check()
+    if jellyfin_album_id not in local_commands:
+        print("This relies on the MBID for the album being correctly set in jellyfin")
+        print("Sometimes the metabrainz plugin does not detect the MBID correctly, in this case you will have to manually set it in jellyfin.")
+        print("By default the script will output a comparison of the album and tracks from jellyfin and musicbrainz for confirmation")
+        session_start()
+    if jellyfin_album_id == "daemon":
+        daemon_serve()
+        return
+    run_command()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])